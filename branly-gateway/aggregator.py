@@ -0,0 +1,152 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import array
+import logging
+import threading
+import collections
+
+log = logging.getLogger(__name__)
+
+# Statistics of the values of one key in one window
+Aggregate = collections.namedtuple("Aggregate", "key start min max mean last count")
+
+class Aggregator:
+    """
+    Streaming aggregation of values in fixed windows of interval seconds,
+    aligned to multiples of interval like the feeds of emoncms. For each key,
+    eg. (node id, contact id), min, max, sum, last and count of the current
+    window are kept in preallocated arrays. add() returns the Aggregate of
+    the previous window when a value of a new window arrives, expire()
+    returns the Aggregates of windows that ended delay seconds ago without
+    being followed by a value. Values older than the current window of their
+    key, or of a window already returned, arrived too late and are dropped.
+    """
+
+    """
+    Class members
+    """
+    interval = False  # Window length (seconds)
+    delay = False     # Time after the end of a window before it is expired (seconds)
+    samples = 0       # Number of values added (int)
+    windows = 0       # Number of Aggregates returned (int)
+    late = 0          # Number of values dropped for arriving too late (int)
+
+    def __init__(self, interval = 10, delay = 2, capacity = 256):
+        self.interval = interval
+        self.delay = delay
+        self.__lock = threading.Lock()
+        self.__slots = {}          # Key -> slot in the arrays below
+        self.__keys = []           # Slot -> key
+        self.__start = array.array("d")  # Start of current window
+        self.__min = array.array("d")
+        self.__max = array.array("d")
+        self.__sum = array.array("d")
+        self.__last = array.array("d")
+        self.__count = array.array("l")  # Values in current window, -1 once returned
+        self.__grow(capacity)
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "Aggregator: %ds windows, %d keys, %d samples, %d windows, %d late" % (self.interval, len(self.__keys), self.samples, self.windows, self.late)
+        return str
+
+    def add(self, key, value, timestamp = None):
+        """
+        Add value of key at timestamp
+        Returns Aggregate of the previous window of key if this value started
+        a new one, else None
+        """
+        if timestamp == None:
+            timestamp = time.time()
+        start = timestamp - timestamp % self.interval
+        value = float(value)
+        with self.__lock:
+            self.samples += 1
+            slot = self.__slots.get(key)
+            if slot == None:
+                slot = len(self.__keys)
+                if slot == len(self.__start):
+                    self.__grow(slot)
+                self.__slots[key] = slot
+                self.__keys.append(key)
+                self.__start[slot] = start
+            aggregate = None
+            if start < self.__start[slot] or (start == self.__start[slot] and self.__count[slot] < 0):
+                self.late += 1
+                return None
+            if start > self.__start[slot]:
+                aggregate = self.__emit(slot)
+                self.__start[slot] = start
+                self.__count[slot] = 0
+            if self.__count[slot] == 0:
+                self.__min[slot] = self.__max[slot] = value
+                self.__sum[slot] = 0
+            else:
+                self.__min[slot] = min(self.__min[slot], value)
+                self.__max[slot] = max(self.__max[slot], value)
+            self.__sum[slot] += value
+            self.__last[slot] = value
+            self.__count[slot] += 1
+            return aggregate
+
+    def expire(self, now = None, force = False):
+        """
+        Return list of Aggregates of windows that ended delay seconds before
+        now, or of all windows if force is True, eg. at shutdown
+        """
+        if now == None:
+            now = time.time()
+        deadline = now - self.interval - self.delay
+        aggregates = []
+        with self.__lock:
+            for slot in range(len(self.__keys)):
+                if self.__count[slot] > 0 and (force or self.__start[slot] <= deadline):
+                    aggregates.append(self.__emit(slot))
+        return aggregates
+
+
+    """ Private methods below, called with self.__lock held """
+
+    def __grow(self, count):
+        """
+        Add room for count more keys
+        """
+        for a in (self.__start, self.__min, self.__max, self.__sum, self.__last):
+            a.extend([0.0] * count)
+        self.__count.extend([0] * count)
+
+    def __emit(self, slot):
+        """
+        Return Aggregate of the current window of slot, None if it is empty or
+        already returned, and mark the window as returned
+        """
+        count = self.__count[slot]
+        if count <= 0:
+            return None
+        self.__count[slot] = -1
+        self.windows += 1
+        return Aggregate(self.__keys[slot], self.__start[slot], self.__min[slot], self.__max[slot], self.__sum[slot] / count, self.__last[slot], count)
@@ -0,0 +1,387 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Branly gateway benchmarks
+
+ Usage
+
+  benchmark.py memory|decode [-n COUNT] [--emoncms PATH]
+  benchmark.py gateway [--nodes N] [--rate PPS] [--duration SECONDS] [--mix MIX]
+                       [--errors RATE] [--latency SECONDS] [--failures RATE]
+                       [--event-loop] [--gateway PATH]
+
+memory   Parse COUNT packets and report bytes kept per packet
+decode   Report packets decoded per second, from text and from binary frames
+gateway  Run the gateway end to end and report packets/s, latency and memory
+
+Use --emoncms to benchmark another copy of emoncms.py, eg. one checked out from
+an older revision, to compare before and after a change.
+
+The gateway benchmark runs branly-gateway.py reading from a pseudo terminal
+instead of the modem and posting to a mock emoncms, in a process of its own,
+answering after --latency seconds and failing --failures of the bulk posts.
+A traffic generator writes packets from --nodes nodes to the pty at --rate
+packets/s. The packet mix is given as type:weight pairs of hello, ping,
+report and value, eg. "value:10,report:5,ping:1". A fraction --errors of the
+packets is corrupted on the way. Each contact value carries a unique counter,
+so the mock emoncms can tell when each packet arrived and the latency from
+the pty to emoncms is measured. Note that a pty is not limited to 115200 baud.
+With --modems the gateway reads several ptys, each getting every packet as if
+heard by several modems.
+"""
+
+
+import sys
+import os
+import imp
+import time
+import struct
+import argparse
+import logging
+import random
+import resource
+import threading
+import multiprocessing
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import json
+
+
+"""
+# "Constants", if there was such a thing in Python
+"""
+# A mix of packets as received from the modem
+kTestPackets = [
+	":P:10:1:-42:00 00 10 25 00;",                              # hello
+	":P:10:1:-42:02 01 12 21 37 ca;",                           # contact list
+	":P:10:1:-42:03 02 31 7c 0b 00 00 32 f5 00 00 00 03 00;",   # contact report
+	":P:10:1:-42:04 03 32 f5 00 00 00;",                        # contact value
+	":P:10:1:-42:04 04 03 0a;",                                 # contact value
+]
+
+
+kPacketMixes = {
+	"hello"  : "00 %02x 10 25 00",             # hello
+	"ping"   : "01 %02x",                      # ping
+	"report" : "03 %02x 31 %s 32 f5 00 00 00", # contact report, counter in contact 1
+	"value"  : "04 %02x 31 %s",                # contact value, counter in contact 1
+}
+kContactList = "02 %02x 12 21"                 # Contacts 1 and 2
+
+
+def loadEmoncms(path):
+	"""
+	Load emoncms module from path
+	"""
+	return imp.load_source("emoncms", path)
+
+def packetParts(message):
+	"""
+	Split modem message the way the gateway does before creating a BranlyPacket
+	"""
+	return message[1:-1].split(":")[1:]
+
+def deepSize(obj, seen):
+	"""
+	Return size in bytes of obj and everything it references, skipping objects
+	in seen. Classes, modules and functions are not counted.
+	"""
+	if id(obj) in seen or isinstance(obj, (type, type(sys), type(deepSize))):
+		return 0
+	seen.add(id(obj))
+	size = sys.getsizeof(obj)
+	if isinstance(obj, dict):
+		for (k, v) in obj.items():
+			size += deepSize(k, seen) + deepSize(v, seen)
+	elif isinstance(obj, (list, tuple, set, frozenset)):
+		for v in obj:
+			size += deepSize(v, seen)
+	if hasattr(obj, "__dict__"):
+		size += deepSize(obj.__dict__, seen)
+	for cls in type(obj).__mro__:
+		for name in cls.__dict__.get("__slots__", ()):
+			if name.startswith("__") and not name.endswith("__"):
+				name = "_%s%s" % (cls.__name__.lstrip("_"), name)
+			if hasattr(obj, name):
+				size += deepSize(getattr(obj, name), seen)
+	return size
+
+def benchMemory(emoncms, count):
+	"""
+	Report bytes kept alive per parsed packet
+	"""
+	messages = [packetParts(kTestPackets[i % len(kTestPackets)]) for i in range(count)]
+	packets = [emoncms.BranlyPacket(parts, 0.0) for parts in messages]
+	seen = set([id(parts) for parts in messages]) # Input is not part of the packet
+	size = sum([deepSize(packet, seen) for packet in packets])
+	print("memory: %d packets, %.1f bytes/packet" % (count, float(size) / count))
+
+
+def benchDecode(emoncms, count):
+	"""
+	Report packets decoded per second from text messages and, if supported,
+	from binary frames
+	"""
+	messages = [packetParts(kTestPackets[i % len(kTestPackets)]) for i in range(count)]
+	start = time.time()
+	for parts in messages:
+		emoncms.BranlyPacket(parts, 0.0)
+	elapsed = time.time() - start
+	print("decode: text   %d packets/s" % (count / elapsed))
+
+	if hasattr(emoncms.BranlyPacket, "fromFrame"):
+		frames = []
+		for parts in messages[:len(kTestPackets)]:
+			packet = emoncms.BranlyPacket(parts, 0.0)
+			frames.append(bytearray([packet.fromAddr, packet.toAddr, packet.rssi & 0xff, packet.type, packet.seqNo]) + packet.payload)
+		frames = [frames[i % len(frames)] for i in range(count)]
+		start = time.time()
+		for frame in frames:
+			emoncms.BranlyPacket.fromFrame(frame, 0.0)
+		elapsed = time.time() - start
+		print("decode: binary %d packets/s" % (count / elapsed))
+
+
+def trafficGenerator(nodes, mix, errorRate, rand):
+	"""
+	Yield (line, counter) of modem packets from nodes, each starting with a
+	contact list. Packet types are picked by the weights of mix. counter is
+	the unique value carried by contact 1, or None. A fraction errorRate of
+	the lines is corrupted.
+	"""
+	seqNos = {}
+	counter = 0
+	types = []
+	for (name, weight) in mix.items():
+		types.extend([name] * weight)
+	while True:
+		nodeId = rand.choice(nodes)
+		if not nodeId in seqNos:
+			seqNos[nodeId] = 0
+			payload = kContactList % 0
+			value = None
+		else:
+			seqNos[nodeId] = (seqNos[nodeId] + 1) % 256
+			kind = rand.choice(types)
+			value = None
+			if "%s" in kPacketMixes[kind]:
+				counter += 1
+				value = counter
+				payload = kPacketMixes[kind] % (seqNos[nodeId], " ".join(["%02x" % b for b in bytearray(struct.pack("<I", value))]))
+			else:
+				payload = kPacketMixes[kind] % seqNos[nodeId]
+		line = ":P:%x:1:%d:%s;" % (nodeId, -rand.randint(30, 90), payload)
+		if rand.random() < errorRate:
+			line = rand.choice([line[:-1], line.replace(" ", " z", 1), line[:len(line) / 2]])
+			value = None
+		yield (line, value)
+
+
+class MockEmoncmsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""
+	Answers the emoncms API calls of the gateway and records the arrival time
+	of each contact 1 value posted in bulk
+	"""
+	def do_GET(self):
+		self.handle_request()
+
+	def do_POST(self):
+		self.handle_request()
+
+	def handle_request(self):
+		server = self.server
+		url = urlparse.urlparse(self.path)
+		length = int(self.headers.getheader("Content-Length") or 0)
+		body = self.rfile.read(length)
+		params = urlparse.parse_qs(url.query or body)
+		time.sleep(server.latency)
+		if url.path.endswith("input/bulk.json"):
+			if server.rand.random() < server.failureRate:
+				server.failures += 1
+				self.reply(500, "")
+				return
+			now = time.time()
+			for sample in json.loads(params["data"][0]):
+				for value in sample[2:]:
+					if "c1" in value:
+						server.arrivals.append((int(value["c1"]), now))
+			server.posts += 1
+			self.reply(200, "ok")
+		elif url.path.endswith("list.json"):
+			self.reply(200, "[]")
+		elif url.path.endswith("feed/create.json"):
+			server.ids += 1
+			self.reply(200, json.dumps({"success" : True, "feedid" : server.ids}))
+		else:
+			server.ids += 1
+			self.reply(200, json.dumps({"success" : True, "created" : True, "idlist" : [server.ids]}))
+
+	def reply(self, code, data):
+		self.send_response(code)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def log_message(self, format, *args):
+		pass
+
+
+class MockEmoncms(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+
+def runMockEmoncms(port, latency, failureRate, results, stop):
+	"""
+	Serve the mock emoncms on port until stop is set, then put the arrival
+	times and counters on results
+	"""
+	server = MockEmoncms(("127.0.0.1", port), MockEmoncmsHandler)
+	server.latency = latency
+	server.failureRate = failureRate
+	server.rand = random.Random(1)
+	server.arrivals = []
+	server.posts = 0
+	server.failures = 0
+	server.ids = 0
+	server.timeout = 0.2
+	while not stop.is_set():
+		server.handle_request()
+	results.put((server.arrivals, server.posts, server.failures))
+
+
+def percentile(values, fraction):
+	"""
+	Return the value below which fraction of the sorted values are
+	"""
+	return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def benchGateway(args):
+	"""
+	Run the gateway reading generated traffic from a pty and posting to a mock
+	emoncms, then report throughput, latency and memory
+	"""
+	import pty
+	import tty
+	gateway = imp.load_source("gateway", args.gateway)
+
+	# Mock emoncms in a process of its own
+	port = 18000 + os.getpid() % 1000
+	results = multiprocessing.Queue()
+	stop = multiprocessing.Event()
+	cms = multiprocessing.Process(target = runMockEmoncms, args = (port, args.latency, args.failures, results, stop))
+	cms.start()
+	time.sleep(0.5)
+
+	masters = []
+	gateway.confSerialPorts = []
+	for i in range(args.modems):
+		(master, slave) = pty.openpty()
+		tty.setraw(slave)
+		masters.append(master)
+		gateway.confSerialPorts.append(os.ttyname(slave))
+	gateway.confEmonCmsServer = "http://127.0.0.1:%d" % port
+	gateway.confEmonCmsCacheFile = False
+	gateway.confEmonCmsBulkMaxDelay = 1
+	gateway.confSpoolDirectory = False
+	gateway.confGatewayEventLoop = args.event_loop
+	gateway.confGatewayProcesses = args.processes
+	gateway.confGatewayStatsInterval = 3600
+	gateway.loggingInit = lambda level: None # Keep the benchmark quiet
+	logging.basicConfig(level = logging.WARNING)
+	gatewayThread = threading.Thread(target = gateway.main)
+	gatewayThread.daemon = True
+	gatewayThread.start()
+	time.sleep(1)
+
+	rand = random.Random(0)
+	mix = dict([(name, int(weight)) for (name, weight) in [item.split(":") for item in args.mix.split(",")]])
+	traffic = trafficGenerator(range(1, args.nodes + 1), mix, args.errors, rand)
+	sent = {}
+	packets = 0
+	bytes = 0
+	start = time.time()
+	while time.time() - start < args.duration:
+		(line, counter) = next(traffic)
+		when = start + float(packets) / args.rate
+		if when > time.time():
+			time.sleep(when - time.time())
+		for master in masters:
+			os.write(master, line + "\r\n")
+		if counter != None:
+			sent[counter] = time.time()
+		packets += 1
+		bytes += len(line) + 2
+	elapsed = time.time() - start
+
+	# Let the gateway drain its queues, then stop it
+	time.sleep(2 + args.latency * 10)
+	gateway.gQuit = True
+	gatewayThread.join(15)
+	stop.set()
+	(arrivals, posts, failures) = results.get()
+	cms.join()
+
+	latencies = sorted([arrival - sent[counter] for (counter, arrival) in arrivals if counter in sent])
+	delivered = len(set([counter for (counter, arrival) in arrivals]))
+	print("gateway: %d nodes, %d modems, %d packets in %.1f s, %d packets/s, %d bytes/s" % (args.nodes, args.modems, packets, elapsed, packets / elapsed, bytes / elapsed))
+	print("gateway: %d of %d values delivered in %d bulk posts, %d posts failed" % (delivered, len(sent), posts, failures))
+	if len(latencies):
+		print("gateway: latency p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s" % (percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99), latencies[-1]))
+	print("gateway: max RSS %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0))
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Branly gateway benchmarks")
+	parser.add_argument("benchmark", choices = ["memory", "decode", "gateway"])
+	parser.add_argument("-n", "--count", type = int, default = 10000, help = "number of packets")
+	parser.add_argument("--emoncms", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emoncms.py"), help = "emoncms.py to benchmark")
+	parser.add_argument("--gateway", default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "branly-gateway.py"), help = "branly-gateway.py to benchmark")
+	parser.add_argument("--nodes", type = int, default = 10, help = "number of nodes")
+	parser.add_argument("--rate", type = float, default = 100, help = "packets per second")
+	parser.add_argument("--duration", type = float, default = 10, help = "seconds of traffic")
+	parser.add_argument("--mix", default = "value:10,report:5,ping:1,hello:1", help = "packet types and weights")
+	parser.add_argument("--errors", type = float, default = 0.01, help = "fraction of corrupted packets")
+	parser.add_argument("--latency", type = float, default = 0.05, help = "response time of the mock emoncms (seconds)")
+	parser.add_argument("--failures", type = float, default = 0, help = "fraction of failing bulk posts")
+	parser.add_argument("--event-loop", action = "store_true", help = "run the gateway in event loop mode")
+	parser.add_argument("--processes", type = int, default = 0, help = "number of gateway worker processes")
+	parser.add_argument("--modems", type = int, default = 1, help = "number of modems hearing every packet")
+	args = parser.parse_args()
+
+	logging.getLogger().setLevel(logging.WARNING)
+	emoncms = loadEmoncms(args.emoncms)
+	if args.benchmark == "memory":
+		benchMemory(emoncms, args.count)
+	elif args.benchmark == "decode":
+		benchDecode(emoncms, args.count)
+	elif args.benchmark == "gateway":
+		benchGateway(args)
+
+
+if __name__ == "__main__":
+	main()
@@ -32,7 +32,8 @@ emoncms.
  Usage
 
 1. Set your emoncms credentials under "User Configuration" below
-2. Make sure tornado, pyserial and requests are installed
+2. Make sure tornado, pyserial and requests are installed (and futures on
+   Python 2)
 3. Check https://github.com/lurch/rpi-serial-console to make sure this script
    is the only process using the RPi UART
 """
@@ -44,17 +45,33 @@ import requests
 import datetime
 import tornado.ioloop
 import tornado.web
+import tornado.gen
+import tornado.concurrent
+import tornado.queues
 import threading
 import sys, traceback
 import json
 import socket
+import signal
 import time, calendar
 import os
 import Queue
 import logging
 import logging.handlers
 import remotelogger
+import atexit
 from emoncms import *
+from rxqueue import *
+from spool import Spool
+from valuefilter import ValueFilter
+from aggregator import Aggregator
+from sinks import *
+from store import SampleStore
+from metrics import gMetrics
+from tracing import gTracer, gProfiler
+from modem import *
+from logqueue import *
+from workers import WorkerPool
 
 
 """
@@ -62,12 +79,94 @@ Emoncms configuration
 """
 confEmonCmsServer = "http://localhost/emoncms"
 confEmonCmsKey = "ff1b9d810ce39fe7009477c5ac83b113"
+confEmonCmsTimeout = (3.05, 10)   # Connect and read timeout of API calls (seconds)
+confEmonCmsRetries = 3            # Retries of failed API calls, with exponential backoff
+confEmonCmsProvisionWorkers = 4   # Threads creating new inputs and feeds in parallel
+confEmonCmsCacheFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "emoncms-cache.json") # Provisioned inputs and feeds, False to disable
+confEmonCmsRefreshInterval = 600  # Reconcile the nodes with feeds changed in the cms this often, 0 for never (seconds)
+confEmonCmsBulk = True            # Post values in batches using input/bulk.json
+confEmonCmsBulkMaxSamples = 100   # Flush batch when this many values are pending
+confEmonCmsBulkMaxDelay = 10      # Flush batch when the oldest value is this old (seconds)
+confFilter = False                # Only post contact values that changed enough, see below. Off so existing
+                                  # fixed interval feeds keep their data
+confFilterDeadband = 0            # Post contact values changing more than this
+confFilterRelative = 0            # and more than this fraction of the last posted value,
+confFilterMinInterval = 0         # at most this often (seconds)
+confFilterHeartbeat = 300         # Post unchanged contact values this often, 0 for never (seconds)
+confFilterContacts = {}           # (node id, contact id) -> dict of filter settings overriding the
+                                  # above, eg. {(16, 1) : {"deadband" : 0.5, "minInterval" : 60}}
+confAggregate = False             # Post one aggregate per contact and window instead of every value
+confAggregateInterval = 10        # Window length, aligned to and used as interval of new feeds (seconds)
+confAggregateExtremes = True      # Also post min and max of each window to inputs c<id>_min and c<id>_max
+confSpoolDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "spool") # Batches are spooled here until posted, False to disable
+confSpoolMaxBytes = 64 * 1024 * 1024 # Max disk space used by the spool
+confSpoolSyncInterval = 5         # Max time between fsyncs of the spool (seconds)
+
+
+"""
+Sink configuration, decoded packets are sent to emoncms and to each sink enabled here
+"""
+confSinkQueueSize = 1000          # Max packets waiting for each sink. When full the emoncms sink follows
+                                  # confRXQueuePolicy, the other sinks drop the oldest
+confMqttHost = False              # MQTT broker, eg. "localhost", False to disable
+confMqttPort = 1883
+confMqttTopic = "branly"          # Values are published to <topic>/<node id>/c<contact id>
+confInfluxUrl = False             # InfluxDB, eg. "http://localhost:8086", False to disable
+confInfluxDatabase = "branly"
+confCsvDirectory = False          # Directory of rotating packet CSV files, False to disable
+confCsvMaxBytes = 10 * 1024 * 1024 # Rotate CSV file at this size
+confCsvBackupCount = 10           # Number of rotated CSV files kept
+confStoreDirectory = False        # Keep recent contact values here, served at /samples on the metrics port,
+                                  # False to disable
+confStoreSamples = 100000         # Values kept per contact, about 18 bytes each
+
+
+"""
+Modem configuration
+"""
+confSerialPorts = None            # Serial ports of the modems, each read by a thread of its own, eg.
+                                  # ["/dev/cu.usbserial"] on a Mac. None for /dev/ttyAMA0 on a Raspberry Pi
+                                  # and test data on a Mac
+confSerialBaudrate = 115200
+confModemBinary = False           # Ask the modems for binary frames, text is still understood
+confModemMergeWindow = 0.1        # With several modems, wait this long for copies of a packet heard by
+                                  # the other modems and keep the one with the best RSSI (seconds)
+
+
+"""
+Gateway configuration
+"""
+confGatewayEventLoop = False      # Run serial, parsing and uploads on the tornado IOLoop
+confGatewayUploads = 4            # Max concurrent uploads to emoncms
+confGatewayQueueSize = 100        # Max lines waiting for the parser in event loop mode
+confRXQueueSize = 1000            # Max lines waiting for the gateway thread
+confRXQueuePolicy = kOverflowCoalesce # What to do when full, here and in the emoncms sink queues: kOverflowBlock,
+                                  # kOverflowDropOldest, kOverflowDropNewest or kOverflowCoalesce (latest value per contact)
+confGatewayStatsInterval = 600    # Log packet loss per node this often (seconds)
+confGatewayProcesses = 0          # Parse and upload in this many worker processes, sharded by node id,
+                                  # each with an emoncms client and sinks of its own. 0 to do it in the
+                                  # gateway process. Workers serve metrics on confMetricsPort + 1 + <n>
+confGatewayProcessQueueSize = 1000 # Max messages waiting for each worker process, more are dropped
+confMetricsPort = 9108            # Serve Prometheus metrics at http://<gateway>:<port>/metrics, False to disable
+confMetricsAddress = ""           # Address to serve metrics on, "" for all
+confTraceSampleRate = 0           # Fraction of messages traced, 0 to disable. Recent traces are
+                                  # dumped on SIGUSR1 and served at /traces on the metrics port. In process
+                                  # mode the workers keep the traces, send SIGUSR1 to their pids
+confTraceBufferSize = 1000        # Number of recent traces kept
+confProfileSeconds = 30           # SIGUSR2 and /profile?seconds=<n> profile the gateway this long
+confTraceDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces") # Trace dumps and profiles go here
+confLogLevel = logging.DEBUG
+confLogQueue = True               # Hand log records to a logging thread instead of writing them in place
+confLogQueueSize = 10000          # Max records waiting for the logging thread, more are dropped
+confLogRate = 20                  # Max records per second of each log message, 0 for no limit
+confLogBurst = 100                # but allow bursts of this many
 
 
 """
 # "Constants", if there was such a thing in Python
 """
 kGatewayVersion = "001" # 0.0.1
+kNodesRetryDelay = 30   # Seconds between attempts to read the nodes from the cms
 
 
 """
@@ -76,74 +175,524 @@ kGatewayVersion = "001" # 0.0.1
 gQuit = False # Quit flag
 gSerialRXQueue = False
 gCMS = False
+gSinks = False # SinkDispatcher
+gStore = False # SampleStore, if enabled
+gLogHandler = False # QueueHandler, if logging through a queue
+gLogListener = False # QueueListener, if logging through a queue
+gWorkers = False # WorkerPool, in process mode
+gShard = None # Index of this worker process, None in the gateway process
 
 
 log = logging.getLogger(__name__)
 
-def uartThread():
+gMetrics.describe("branly_lines_total", "counter", "Messages received from the modem by type, P, #, frame or invalid")
+gMetrics.describe("branly_parse_errors_total", "counter", "Packets that could not be decoded")
+gMetrics.describe("branly_stage_seconds", "histogram", "Time spent waiting in the RX queue and parsing")
+gMetrics.describe("branly_rx_queue", "gauge", "RX queue size and counters")
+gMetrics.describe("branly_sink_queue", "gauge", "Sink queue sizes and counters")
+gMetrics.describe("branly_node_rssi", "gauge", "RSSI of the last packet from each node heard by each modem")
+gMetrics.describe("branly_node_last_seen_seconds", "gauge", "Arrival time of the last packet from each node")
+gMetrics.describe("branly_node_packets", "gauge", "Packets received, lost and duplicated per node")
+gMetrics.describe("branly_log_records", "gauge", "Log records dropped by a full log queue or suppressed by the rate limit")
+gMetrics.describe("branly_worker_queue", "gauge", "Worker process queue sizes and counters")
+
+def uartThread(port):
 	"""
-	This thread handles RX from the UART. Lines received are posted one by one
-	to the gSerialRXQueue queue. The reason for keeping a separate thread
-	handeling the UART is that the emoncms thread might hang for some time due to
-	network latency and we do not want to miss any data received on the UART.
+	This thread handles RX from the UART of one modem. Messages received are
+	posted one by one to the gSerialRXQueue queue as (time of arrival,
+	message, modem name) tuples. The reason for keeping a separate thread
+	handeling the UART is that the emoncms thread might hang for some time due
+	to network latency and we do not want to miss any data received on the
+	UART.
 	"""
-	log.info("UART thread running")
 	global gSerialRXQueue
 	global qQuit
-	if sys.platform == "darwin":
-		# Special case for development on a Mac
-		serialPort = serial.Serial("/dev/cu.usbserial", 115200, timeout=0.5)
-	else: # Assume Raspberry Pi
-		serialPort = serial.Serial("/dev/ttyAMA0", 115200, timeout=0.5)
+	modem = modemName(port)
+	log.info("UART thread of %s running", modem)
+	serialPort = openSerialPort(port, 0.5)
+	decoder = ModemDecoder()
 
 	while not gQuit:
-		message = serialPort.readlines(None)
-		if (len(message)):
-			log.debug( "UART thread got '%s'" % message)
-			for line in message:
-				line = line.rstrip()
-				if len(line) > 0:
-					gSerialRXQueue.put(line)
+		# Wait for at least one byte, then take all that has arrived. The
+		# timeout only matters when the line is idle.
+		data = serialPort.read(max(1, serialPort.inWaiting()))
+		if len(data):
+			rxTime = time.time()
+			messages = decoder.feed(data)
+			if len(messages):
+				log.debug("UART thread of %s got '%s'", modem, messages)
+			for message in messages:
+				checkModemBoot(serialPort, message)
+				gSerialRXQueue.put((rxTime, message, modem))
 	serialPort.close()
 
 
+def serialPorts():
+	"""
+	Return list of the serial ports to read, empty when running on test data
+	"""
+	if confSerialPorts:
+		return confSerialPorts
+	if sys.platform == "darwin":
+		# Development on a Mac
+		return []
+	return ["/dev/ttyAMA0"] # Assume Raspberry Pi
+
+
+def modemName(port):
+	"""
+	Return name of the modem on serial port, eg. ttyUSB0
+	"""
+	return os.path.basename(port)
+
+
+def openSerialPort(port, timeout):
+	"""
+	Open the serial port of a BranlyPi modem
+	"""
+	serialPort = serial.Serial(port, confSerialBaudrate, timeout=timeout)
+	if confModemBinary:
+		serialPort.write(kModemRequestBinary)
+	return serialPort
+
+
+def checkModemBoot(serialPort, message):
+	"""
+	A reset modem sends text, ask for binary frames again
+	"""
+	if confModemBinary and not isinstance(message, bytearray) and message.startswith(kModemBootBanner):
+		log.info("Modem restarted, requesting binary frames")
+		serialPort.write(kModemRequestBinary)
+
+
 """
 Message handling
 """
 
+def coalesceKey(item):
+	"""
+	Return (node id, contact id) of a queued contact value message, None for
+	all other messages. Used by the coalesce policy of gSerialRXQueue.
+	"""
+	(rxTime, message, modem) = item
+	if isinstance(message, bytearray):
+		# <from> <to> <rssi> 04 <seq> <flags/size/id> <value>
+		if len(message) > 5 and message[3] == kPacketContactValue:
+			return (textNodeId(message[0]), message[5] & 0x0f)
+		return None
+	# ":P:<from>:<to>:<rssi>:04 <seq> <flags/size/id> <value>;"
+	parts = message.split(":")
+	if len(parts) == 6 and parts[1] == "P" and parts[5].startswith("04 "):
+		try:
+			return (int(parts[2], 16), int(parts[5][6:8], 16) & 0x0f)
+		except ValueError:
+			pass
+	return None
+
+def packetCoalesceKey(packet):
+	"""
+	Return (node id, contact id) of a contact value packet, None for all
+	other packets. Used by the coalesce policy of the emoncms sink queues.
+	"""
+	if packet.type == kPacketContactValue:
+		return (packet.fromAddr, packet.contactValues[0].id)
+	return None
+
+def messageNode(message):
+	"""
+	Return node id of the sender of a packet message, None for all other
+	messages. Used to shard messages between the worker processes.
+	"""
+	if isinstance(message, bytearray):
+		if len(message) > 0:
+			return textNodeId(message[0])
+		return None
+	# ":P:<from>:..."
+	if message.startswith(":P:"):
+		try:
+			return int(message[3:message.find(":", 3)], 16)
+		except ValueError:
+			pass
+	return None
+
 def validMessage(message):
 	"""
 	Return True if message is valid. Messages are formatted as ":<data>;"
 	"""
 	return message.count(';') == 1 and message.startswith(':') and message.endswith(';')
 
-def handlePacketMessage(message):
+def parseMessage(rxTime, message, modem = None):
+	"""
+	Parse line or binary frame received from the named modem. Debug messages
+	are logged.
+	Returns a valid BranlyPacket or None
+	"""
+	start = time.time()
+	gMetrics.observe("branly_stage_seconds", {"stage" : "queue"}, start - rxTime)
+	packet = None
+	if isinstance(message, bytearray):
+		gMetrics.inc("branly_lines_total", {"type" : "frame"})
+		packet = BranlyPacket.fromFrame(message, rxTime)
+		if not packet.valid:
+			log.error("Illegal packet")
+			gMetrics.inc("branly_parse_errors_total")
+			packet = None
+	elif message[0] == "#":
+		# Debug messages from the BranlyPi modem
+		gMetrics.inc("branly_lines_total", {"type" : "#"})
+		handleDebugMessage(message, modem)
+	else:
+		if validMessage(message): # TODO: Move to BranlyPacket, or not
+			msgType = message[1]
+			gMetrics.inc("branly_lines_total", {"type" : msgType})
+			if msgType == "P":
+				packet = parsePacketMessage(message, rxTime)
+				if packet == None:
+					gMetrics.inc("branly_parse_errors_total")
+			else:
+				log.error("Unknown type '%s' in packet '%s'", msgType, message)
+		else:
+			gMetrics.inc("branly_lines_total", {"type" : "invalid"})
+			log.error("Invalid message '%s'", message)
+	gMetrics.observe("branly_stage_seconds", {"stage" : "parse"}, time.time() - start)
+	if packet:
+		packet.modem = modem
+	if packet and gTracer.enabled:
+		packet.trace = gTracer.start("receive", rxTime)
+		if packet.trace != None:
+			gTracer.event(packet.trace, "dequeue", start)
+			gTracer.event(packet.trace, "decode")
+	return packet
+
+def parsePacketMessage(message, rxTime = None):
 	"""
 	Radio packet message received
+	Returns a valid BranlyPacket or None
 	"""
 	message = message[1:] # Remove message start and end markers
 	message = message[:-1]
 	parts = message.split(":")
-	packet = BranlyPacket(parts[1:])
+	packet = BranlyPacket(parts[1:], rxTime)
 	if packet.valid:
-		# TODO: Send packets to emoncms sinks
-		if not gCMS.handlePacket(packet):
-			log.error("Error: CMS packet handeling failed")
+		return packet
+	log.error("Illegal packet")
+	return None
+
+def handleMessage(rxTime, message, modem):
+	"""
+	Parse message and hand the packet to the sinks, or in process mode pass
+	packet messages on to the worker process of the sending node
+	"""
+	if gWorkers:
+		nodeId = messageNode(message)
+		if nodeId != None:
+			gWorkers.put(nodeId, (rxTime, message, modem))
+			return
+	packet = parseMessage(rxTime, message, modem)
+	if packet:
+		handlePacket(packet)
+
+def handlePacket(packet):
+	"""
+	Send decoded radio packet to the cms and other sinks
+	"""
+	gMetrics.set("branly_node_rssi", {"node" : packet.fromAddr, "modem" : packet.modem}, packet.rssi)
+	gMetrics.set("branly_node_last_seen_seconds", {"node" : packet.fromAddr}, packet.timestamp)
+	gSinks.put(packet)
+
+
+def collectMetrics(metrics):
+	"""
+	Update gauges of queues and nodes before metrics are served
+	"""
+	if gSerialRXQueue:
+		for (name, value) in gSerialRXQueue.stats().items():
+			metrics.set("branly_rx_queue", {"counter" : name}, value)
+	if gSinks:
+		for (sink, stats) in gSinks.stats().items():
+			for (name, value) in stats.items():
+				metrics.set("branly_sink_queue", {"sink" : sink, "counter" : name}, value)
+		for nodeId in gSinks.sequences.nodes():
+			for (name, value) in gSinks.sequences.stats(nodeId).items():
+				metrics.set("branly_node_packets", {"node" : nodeId, "counter" : name}, value)
+	if gWorkers:
+		for (index, stats) in enumerate(gWorkers.stats()):
+			for (name, value) in stats.items():
+				metrics.set("branly_worker_queue", {"worker" : index, "counter" : name}, value)
+	if gLogHandler:
+		metrics.set("branly_log_records", {"counter" : "dropped"}, gLogHandler.dropped)
+		for f in gLogHandler.filters:
+			metrics.set("branly_log_records", {"counter" : "suppressed"}, f.suppressed)
+
+
+def dumpTraces():
+	"""
+	Write the buffered traces to confTraceDirectory
+	Returns name of the file written
+	"""
+	if not os.path.isdir(confTraceDirectory):
+		os.makedirs(confTraceDirectory)
+	path = shardPath(os.path.join(confTraceDirectory, time.strftime("traces-%Y%m%d-%H%M%S.json")))
+	traces = gTracer.traces()
+	with open(path, "wb") as f:
+		json.dump(traces, f, indent = 1)
+	log.info("Wrote %d traces to %s" % (len(traces), path))
+	return path
+
+
+def startProfile(seconds):
+	"""
+	Profile the gateway for seconds, the result is written to confTraceDirectory
+	Returns name of the file to be written or None if already profiling
+	"""
+	if not os.path.isdir(confTraceDirectory):
+		os.makedirs(confTraceDirectory)
+	path = shardPath(os.path.join(confTraceDirectory, time.strftime("profile-%Y%m%d-%H%M%S.folded")))
+	if gProfiler.start(seconds, path):
+		return path
+	return None
+
+
+def signalHandler(signum, frame):
+	"""
+	SIGUSR1 dumps traces, SIGUSR2 starts profiling. Each process handles the
+	signals sent to it, in process mode the traces are kept by the workers.
+	"""
+	if signum == signal.SIGUSR1:
+		if gWorkers:
+			log.info("Packets are traced by the worker processes, send SIGUSR1 to %s" % " ".join(["%d" % pid for pid in gWorkers.pids()]))
+		dumpTraces()
+	elif signum == signal.SIGUSR2:
+		startProfile(confProfileSeconds)
+
+
+def installSignalHandlers():
+	"""
+	Handle SIGUSR1 and SIGUSR2 in this process, see signalHandler
+	"""
+	try:
+		signal.signal(signal.SIGUSR1, signalHandler)
+		signal.signal(signal.SIGUSR2, signalHandler)
+	except ValueError:
+		pass # Not the main thread, eg. when benchmarking
+
+
+class TracesHandler(tornado.web.RequestHandler):
+	"""
+	Serves the buffered traces as JSON
+	"""
+	def get(self):
+		self.set_header("Content-Type", "application/json")
+		self.write(json.dumps(gTracer.traces()))
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+	"""
+	Starts profiling, for ?seconds=<n> or confProfileSeconds
+	"""
+	def get(self):
+		path = startProfile(float(self.get_argument("seconds", confProfileSeconds)))
+		if path == None:
+			self.set_status(409)
+			self.write("Already profiling\n")
+		else:
+			self.write("Profiling to %s\n" % path)
+
+
+class SamplesHandler(tornado.web.RequestHandler):
+	"""
+	Serves the local sample store as JSON. Without node and contact the
+	stored contacts are listed, else the samples of ?node=<id>&contact=<id>,
+	optionally from start to end (unix time), downsampled to step seconds and
+	limited to the limit most recent rows. Queries run in the executor of
+	the IOLoop, as scanning a full ring takes a while.
+	"""
+	@tornado.gen.coroutine
+	def get(self):
+		if not gStore:
+			self.set_status(404)
+			if gWorkers:
+				self.write("Samples are served by the worker processes on their metrics ports\n")
+			else:
+				self.write("No sample store, see confStoreDirectory\n")
+			return
+		self.set_header("Content-Type", "application/json")
+		node = self.get_argument("node", None)
+		contact = self.get_argument("contact", None)
+		if node == None or contact == None:
+			self.write(json.dumps(gStore.series()))
+			return
+		try:
+			end = self.get_argument("end", None)
+			step = self.get_argument("step", None)
+			args = (int(node), int(contact), float(self.get_argument("start", 0)), end and float(end), step and float(step), int(self.get_argument("limit", 10000)))
+		except ValueError:
+			raise tornado.web.HTTPError(400)
+		rows = yield tornado.ioloop.IOLoop.current().run_in_executor(None, gStore.query, *args)
+		self.write(json.dumps(rows))
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+	"""
+	Serves gMetrics in the Prometheus text format
+	"""
+	def get(self):
+		self.set_header("Content-Type", "text/plain; version=0.0.4")
+		self.write(gMetrics.render())
+
+
+def startMetricsServer(port):
+	"""
+	Serve metrics, traces, profiling and samples on port. In thread mode and in worker
+	processes the server gets an IOLoop and thread of its own, in event loop
+	mode it runs on the main IOLoop.
+	"""
+	application = tornado.web.Application([(r"/metrics", MetricsHandler), (r"/traces", TracesHandler), (r"/profile", ProfileHandler), (r"/samples", SamplesHandler)])
+	def serve():
+		ioloop = tornado.ioloop.IOLoop()
+		ioloop.make_current()
+		application.listen(port, confMetricsAddress)
+		ioloop.start()
+
+	gMetrics.addCollector(collectMetrics)
+	if confGatewayEventLoop and gShard == None:
+		application.listen(port, confMetricsAddress)
 	else:
-		log.error("Illegal packet")
+		thread = threading.Thread(target = serve)
+		thread.daemon = True
+		thread.start()
+	log.info("Serving metrics on port %d" % port)
+
+
+def logNodeStats():
+	"""
+	Log packets received, lost and duplicated per node and packets handled
+	per sink
+	"""
+	if gWorkers:
+		log.info(gWorkers)
+	if not gSinks:
+		return # Logged by the worker processes
+	for nodeId in sorted(gSinks.sequences.nodes()):
+		stats = gSinks.sequences.stats(nodeId)
+		log.info("Node %d: %d received, %d lost (%.1f%%), %d duplicates" % (nodeId, stats["received"], stats["lost"], 100 * stats["lossRate"], stats["duplicates"]))
+	for (name, stats) in sorted(gSinks.stats().items()):
+		log.info("Sink %s: %d handled, %d failed, %d dropped, %d queued" % (name, stats["handled"], stats["failed"], stats["dropped"], stats["size"]))
+	if gSinks.mergeWindow:
+		log.info("Merged %d packets heard by more than one modem" % gSinks.merged)
+
+
+def shardPath(path):
+	"""
+	Return path of a file or directory of the gateway, in worker processes
+	made unique to the worker
+	"""
+	if gShard == None:
+		return path
+	(root, ext) = os.path.splitext(path)
+	return "%s-%d%s" % (root, gShard, ext)
+
+
+def createEmoncms():
+	"""
+	Return Emoncms client as configured
+	"""
+	cms = Emoncms(confEmonCmsServer, confEmonCmsKey, confEmonCmsTimeout, confEmonCmsRetries, poolSize = confGatewayUploads + confEmonCmsProvisionWorkers, provisionWorkers = confEmonCmsProvisionWorkers)
+	if confEmonCmsCacheFile:
+		cms.enableProvisioningCache(shardPath(confEmonCmsCacheFile))
+	if confEmonCmsBulk:
+		cms.enableBulk(confEmonCmsBulkMaxSamples, confEmonCmsBulkMaxDelay)
+		if confSpoolDirectory:
+			cms.enableSpool(Spool(shardPath(confSpoolDirectory), maxBytes = confSpoolMaxBytes, syncInterval = confSpoolSyncInterval))
+	if confAggregate:
+		cms.enableAggregation(Aggregator(confAggregateInterval), confAggregateExtremes)
+	if confFilter:
+		cms.enableFilter(ValueFilter(confFilterDeadband, confFilterRelative, confFilterMinInterval, confFilterHeartbeat, confFilterContacts))
+#	cms.enableDebug()
+	return cms
+
+
+def refreshNodes():
+	"""
+	Read the nodes from the cms and log them, retrying every kNodesRetryDelay
+	seconds until the cms answers
+	"""
+	while not gQuit:
+		nodes = gCMS.readBranlyNodes()
+		if nodes != None:
+			for node in nodes:
+				log.info(" %s" % node)
+				for contact in node.contacts:
+					log.info("  %s" % contact)
+			return
+		log.error("Failed to read nodes from the cms, retrying in %d seconds" % kNodesRetryDelay)
+		time.sleep(kNodesRetryDelay)
+
+
+def nodeRefresher(cms, refreshNow):
+	"""
+	Thread reconciling the nodes of cms with the cms every
+	confEmonCmsRefreshInterval seconds, until cms is replaced by a restart
+	"""
+	if refreshNow:
+		refreshNodes()
+	while not gQuit and confEmonCmsRefreshInterval:
+		time.sleep(confEmonCmsRefreshInterval)
+		if cms is not gCMS:
+			return
+		cms.readBranlyNodes()
+
+
+def loadNodes():
+	"""
+	Make sure gCMS knows the nodes before packets are handled. If nodes were
+	read from the cache file we start right away and reconcile them with the
+	cms in the background, else we wait for the cms.
+	"""
+	warm = len(gCMS.nodes) > 0
+	if warm:
+		log.info("Warm start with %d nodes from the cache" % len(gCMS.nodes))
+	else:
+		refreshNodes()
+	thread = threading.Thread(target = nodeRefresher, args = (gCMS, warm), name = "refresh-nodes")
+	thread.daemon = True
+	thread.start()
+
+
+def createSinks():
+	"""
+	Return SinkDispatcher delivering packets to gCMS and the configured sinks
+	"""
+	if len(serialPorts()) > 1:
+		sinks = SinkDispatcher(mergeWindow = confModemMergeWindow)
+	else:
+		sinks = SinkDispatcher()
+	sinks.addSink("emoncms", gCMS, confGatewayUploads, confSinkQueueSize, confRXQueuePolicy, packetCoalesceKey)
+	if confMqttHost:
+		sinks.addSink("mqtt", MqttSink(confMqttHost, confMqttPort, confMqttTopic), queueSize = confSinkQueueSize)
+	if confInfluxUrl:
+		sinks.addSink("influxdb", InfluxSink(confInfluxUrl, confInfluxDatabase), queueSize = confSinkQueueSize)
+	if confCsvDirectory:
+		sinks.addSink("csv", CsvSink(shardPath(confCsvDirectory), confCsvMaxBytes, confCsvBackupCount), queueSize = confSinkQueueSize)
+	if confStoreDirectory:
+		global gStore
+		gStore = SampleStore(shardPath(confStoreDirectory), confStoreSamples)
+		sinks.addSink("store", gStore, queueSize = confSinkQueueSize)
+	log.info(sinks)
+	return sinks
 
 		
-def handleDebugMessage(message):
+def handleDebugMessage(message, modem = None):
 	"""
 	Debug message received from modem
 	"""
-	log.debug("MODEM:%s" % (message))
+	log.debug("MODEM %s:%s", modem, message)
 
 
 def gatewayThread():
 	"""
-	# This thread receives lines from the gSerialRXQueue queue and posts data to
-	# emoncms. 
+	# This thread receives lines from the gSerialRXQueue queue and hands packets
+	# to the sinks.
 	"""
 	global gQuit
 	global gSerialRXQueue
@@ -151,20 +700,12 @@ def gatewayThread():
 	log.info("Gateway thread running")
 	while not gQuit:
 		try:
-			message = gSerialRXQueue.get()
-			if message[0] == "#":
-				# Debug messages from the BranlyPi modem
-				handleDebugMessage(message)
-			else:
-				if validMessage(message): # TODO: Move to BranlyPacket, or not
-					msgType = message[1]
-					if msgType == "P":
-						handlePacketMessage(message)
-					else:
-						log.error("Unknown type '%s' in packet '%s'" % (msgType, message))
-				else:
-					log.error("Invalid message '%s'" % (message))
-				
+			try:
+				(rxTime, message, modem) = gSerialRXQueue.get(timeout = 1)
+			except Queue.Empty:
+				continue
+			handleMessage(rxTime, message, modem)
+
 		except NameError as e:
 			log.critical("Gateway got NameError exception", exc_info=True)
 #			print traceback.format_exc()
@@ -174,35 +715,153 @@ def gatewayThread():
 #			print traceback.format_exc()
 
 
-def addTestData():
+def testMessages():
 	"""
-	Add test packets
+	Return list of test packets
 	Packet format :":P:<from>:<to>:<rssi>:<data 0> <data 1> <data 2> ... <data n>;"
 	"""
+	lines = []
 
 	# hello
-	gSerialRXQueue.put(":P:10:1:-42:00 00 10 25 00;")
+	lines.append(":P:10:1:-42:00 00 10 25 00;")
 
 	# contact list
-	gSerialRXQueue.put(":P:10:1:-42:02 01 12 21 37 ca;")
+	lines.append(":P:10:1:-42:02 01 12 21 37 ca;")
 
 	# contact report
-	gSerialRXQueue.put(":P:10:1:-42:03 02 31 7c 0b 00 00 32 f5 00 00 00 03 00;")
+	lines.append(":P:10:1:-42:03 02 31 7c 0b 00 00 32 f5 00 00 00 03 00;")
 
 	# reports
-	gSerialRXQueue.put(":P:10:1:-42:04 03 32 f5 00 00 00;")
-	gSerialRXQueue.put(":P:10:1:-42:04 04 03 0a;")
-	gSerialRXQueue.put(":P:10:1:-42:04 05 31 7c 0b 00 00;")
-	gSerialRXQueue.put(":P:10:1:-42:04 06 03 0a;")
-	gSerialRXQueue.put(":P:10:1:-42:04 07 32 f5 00 00 00;")
+	lines.append(":P:10:1:-42:04 03 32 f5 00 00 00;")
+	lines.append(":P:10:1:-42:04 04 03 0a;")
+	lines.append(":P:10:1:-42:04 05 31 7c 0b 00 00;")
+	lines.append(":P:10:1:-42:04 06 03 0a;")
+	lines.append(":P:10:1:-42:04 07 32 f5 00 00 00;")
+
+	# binary frame
+	lines.extend(ModemDecoder().feed(encodeFrame(10, 1, -42, bytearray.fromhex("04 08 03 0b"))))
 
 	# Illegal message
-	gSerialRXQueue.put(":P:10:1:-42:00 00 10 25 00")
+	lines.append(":P:10:1:-42:00 00 10 25 00")
 
 	# Debug message
-	gSerialRXQueue.put("# Hello world")
-	gSerialRXQueue.put("\n# FRQ:868 RTEMP:45\n")
-	gSerialRXQueue.put("\n")
+	lines.append("# Hello world")
+	lines.append("\n# FRQ:868 RTEMP:45\n")
+	lines.append("\n")
+	return lines
+
+
+def addTestData():
+	"""
+	Add test packets to the gSerialRXQueue queue
+	"""
+	for line in testMessages():
+		gSerialRXQueue.put((time.time(), line, "test"))
+
+
+"""
+Event loop mode
+
+Instead of the UART and gateway threads, serial reads and parsing run as
+coroutines on the tornado IOLoop and hand packets to the sinks:
+
+  uartReader (per modem) -> line queue -> packetParser -> sink queues -> sink workers
+
+The line queue is bounded. With the kOverflowBlock policy the parser waits
+while the emoncms sink queues are full, so the line queue fills and the UART
+readers wait in turn, without ever blocking the IOLoop. The sink workers are
+threads doing the blocking uploads, confGatewayUploads of them for emoncms.
+Packets of the same node are uploaded in order.
+"""
+
+def readSerial(serialPort):
+	"""
+	Return a Future resolved with the bytes available on the non blocking
+	serialPort once it becomes readable
+	"""
+	ioloop = tornado.ioloop.IOLoop.current()
+	future = tornado.concurrent.Future()
+	def onReadable(fd, events):
+		ioloop.remove_handler(fd)
+		try:
+			future.set_result(serialPort.read(max(1, serialPort.inWaiting())))
+		except Exception as e:
+			future.set_exception(e)
+	ioloop.add_handler(serialPort.fileno(), onReadable, tornado.ioloop.IOLoop.READ)
+	return future
+
+
+@tornado.gen.coroutine
+def uartReader(lineQueue, port):
+	"""
+	Read lines and frames from the UART of a modem and put them on lineQueue
+	as (time of arrival, message, modem name) tuples
+	"""
+	modem = modemName(port)
+	log.info("UART reader of %s running", modem)
+	serialPort = openSerialPort(port, 0)
+	decoder = ModemDecoder()
+	try:
+		while not gQuit:
+			data = yield readSerial(serialPort)
+			rxTime = time.time()
+			for message in decoder.feed(data):
+				checkModemBoot(serialPort, message)
+				yield lineQueue.put((rxTime, message, modem))
+	finally:
+		serialPort.close()
+
+
+@tornado.gen.coroutine
+def testDataReader(lineQueue):
+	"""
+	Put test packets on lineQueue
+	"""
+	for line in testMessages():
+		yield lineQueue.put((time.time(), line, "test"))
+
+
+@tornado.gen.coroutine
+def packetParser(lineQueue):
+	"""
+	Parse lines from lineQueue and hand valid packets to the sinks, whose
+	worker threads do the uploading. Waits while the sinks are blocked.
+	"""
+	while True:
+		(rxTime, message, modem) = yield lineQueue.get()
+		while gSinks and gSinks.blocked():
+			yield tornado.gen.sleep(0.01) # Wait for room rather than blocking the IOLoop
+		try:
+			handleMessage(rxTime, message, modem)
+		except Exception as e:
+			log.critical("Parser got exception", exc_info=True)
+		finally:
+			lineQueue.task_done()
+
+
+def eventLoop():
+	"""
+	Run the gateway on the tornado IOLoop until gQuit is set
+	"""
+	ioloop = tornado.ioloop.IOLoop.current()
+	lineQueue = tornado.queues.Queue(maxsize = confGatewayQueueSize)
+	log.info("Event loop running")
+
+	if len(serialPorts()) == 0:
+		ioloop.spawn_callback(testDataReader, lineQueue)
+	else:
+		for port in serialPorts():
+			ioloop.spawn_callback(uartReader, lineQueue, port)
+	ioloop.spawn_callback(packetParser, lineQueue)
+
+	def tick():
+		if gQuit:
+			ioloop.stop()
+	tornado.ioloop.PeriodicCallback(tick, 1000).start()
+	tornado.ioloop.PeriodicCallback(logNodeStats, confGatewayStatsInterval * 1000).start()
+	if gWorkers:
+		tornado.ioloop.PeriodicCallback(gWorkers.supervise, 1000).start()
+	ioloop.start()
 
 
 
@@ -232,12 +891,101 @@ def loggingInit(level = logging.INFO):
 		logger.addHandler(logfile)
 
 	# Log to stdout
-	ch = logging.StreamHandler(sys.stdout)
+	if confLogQueue:
+		ch = BufferedStreamHandler(sys.stdout)
+	else:
+		ch = logging.StreamHandler(sys.stdout)
 	formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 	ch.setFormatter(formatter)
 	logger.addHandler(ch)
 
-	
+	if confLogQueue:
+		# Move the handlers to a logging thread, logging threads only queue the record
+		global gLogHandler
+		global gLogListener
+		listener = QueueListener(Queue.Queue(confLogQueueSize), logger.handlers[:])
+		for handler in listener.handlers:
+			logger.removeHandler(handler)
+		gLogHandler = QueueHandler(listener.queue)
+		if confLogRate:
+			gLogHandler.addFilter(RateLimitFilter(confLogRate, confLogBurst))
+		logger.addHandler(gLogHandler)
+		listener.start()
+		atexit.register(listener.stop)
+		gLogListener = listener
+
+
+def closeSinks():
+	"""
+	Stop the worker processes and close the sinks
+	"""
+	global gWorkers
+	if gWorkers:
+		gWorkers.stop()
+		gWorkers = False
+	if gSinks:
+		gSinks.close()
+
+
+def workerProcess(index, queue):
+	"""
+	Worker process of process mode. Parses the messages of its shard of nodes
+	from queue and hands the packets to an emoncms client and sinks of its
+	own, until it gets None or the gateway process is gone.
+	"""
+	global gShard
+	global gCMS
+	global gSinks
+	global gWorkers
+	gShard = index
+	gWorkers = False
+	parent = os.getppid()
+	# Restarted workers are forked while the threads of the gateway process
+	# run, a lock held by one of them at that moment would never be released
+	logging._lock = threading.RLock()
+	gMetrics.afterFork()
+	gProfiler.afterFork()
+	signal.signal(signal.SIGINT, signal.SIG_IGN) # The gateway process handles Ctrl-C
+	installSignalHandlers() # Not inherited by the workers started before the gateway process installed them
+
+	# The logging thread of the gateway process is not running here
+	logger = logging.getLogger()
+	for handler in logger.handlers[:]:
+		logger.removeHandler(handler)
+	loggingInit(confLogLevel)
+	log.info("Worker %d running", index)
+
+	gCMS = createEmoncms()
+	loadNodes()
+	gSinks = createSinks()
+	if confMetricsPort:
+		startMetricsServer(confMetricsPort + 1 + index)
+	lastNodeStats = time.time()
+	try:
+		while os.getppid() == parent:
+			try:
+				item = queue.get(timeout = 1)
+			except Queue.Empty:
+				item = False
+			if item == None:
+				break
+			if item:
+				try:
+					packet = parseMessage(*item)
+					if packet:
+						handlePacket(packet)
+				except Exception as e:
+					log.critical("Worker %d got exception", index, exc_info=True)
+			if time.time() - lastNodeStats >= confGatewayStatsInterval:
+				logNodeStats()
+				lastNodeStats = time.time()
+	finally:
+		gSinks.close()
+		log.info("Worker %d stopped", index)
+		if gLogListener:
+			gLogListener.stop()
+
+
 def main():
 	"""
 	Trusty 'ol main
@@ -245,36 +993,63 @@ def main():
 	global gQuit
 	global gSerialRXQueue
 	global gCMS
+	global gSinks
+	global gWorkers
 
-	loggingInit(logging.DEBUG)
+	loggingInit(confLogLevel)
 
 	logging.getLogger("requests").setLevel(logging.WARNING) # Kill request logging
-	gCMS = Emoncms(confEmonCmsServer, confEmonCmsKey)
-#	gCMS.enableDebug()
 	log.info("Branly Pi Gateway %s running on %s" % (kGatewayVersion, sys.platform))
-	log.info(gCMS)
-
-	if 1:
-		nodes = gCMS.readBranlyNodes()
-		for node in nodes:
-			log.info(" %s" % node)
-			for contact in node.contacts:
-				log.info("  %s" % contact)
+	gTracer.configure(confTraceSampleRate, confTraceBufferSize)
+	if confGatewayProcesses:
+		gWorkers = WorkerPool(confGatewayProcesses, workerProcess, confGatewayProcessQueueSize)
+		gWorkers.start()
+		log.info(gWorkers)
+	else:
+		gCMS = createEmoncms()
+		log.info(gCMS)
+		loadNodes()
+		gSinks = createSinks()
+	installSignalHandlers()
+	if confMetricsPort:
+		startMetricsServer(confMetricsPort)
+	if confGatewayEventLoop:
+		try:
+			eventLoop()
+		except KeyboardInterrupt:
+			log.info("Shutdown requested...exiting")
+			gQuit = True
+			sys.exit(1)
+		finally:
+			closeSinks()
+		return
 
-	gSerialRXQueue = Queue.Queue()
+	gSerialRXQueue = RXQueue(confRXQueueSize, confRXQueuePolicy, coalesceKey)
 
 	gwThr = threading.Thread(target=gatewayThread)
 	gwThr.daemon=True
 	gwThr.start()
-	if sys.platform == "darwin":
+	if len(serialPorts()) == 0:
 		addTestData()
 	else:
-		uartThr = threading.Thread(target=uartThread)
-		uartThr.daemon=True
-		uartThr.start()
+		for port in serialPorts():
+			uartThr = threading.Thread(target=uartThread, args=(port,))
+			uartThr.daemon=True
+			uartThr.start()
 	try:
+		lastStats = {"dropped" : 0, "coalesced" : 0}
+		lastNodeStats = time.time()
 		while not gQuit:
 			time.sleep(1) # TODO: Increase in production
+			stats = gSerialRXQueue.stats()
+			if stats["dropped"] != lastStats["dropped"] or stats["coalesced"] != lastStats["coalesced"]:
+				log.warning("RX queue full, %s" % gSerialRXQueue)
+			lastStats = stats
+			if time.time() - lastNodeStats >= confGatewayStatsInterval:
+				logNodeStats()
+				lastNodeStats = time.time()
+			if gWorkers:
+				gWorkers.supervise()
 	except KeyboardInterrupt:
 		log.info("Shutdown requested...exiting")
 		gQuit = True
@@ -283,6 +1058,8 @@ def main():
 		log.critical("GW got exception ", exc_info=True)
 		gQuit = True
 		sys.exit(1)
+	finally:
+		closeSinks()
 
 
 if __name__ == "__main__":
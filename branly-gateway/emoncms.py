@@ -21,10 +21,18 @@
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import requests
+import requests.adapters
 import json
 import time
 import logging
 import httplib
+import threading
+import Queue
+import os
+import collections
+import struct
+from metrics import gMetrics
+from tracing import gTracer
 
 # Radio packets types
 kPacketHello = 0
@@ -33,9 +41,28 @@ kPacketContactList = 2
 kPacketContactReport = 3
 kPacketContactValue = 4
 
+kProvisionRetryDelay = 60 # Seconds before retrying failed provisioning of an input
+kProvisionMaxBuffered = 100 # Max values buffered per input being provisioned
+
+# Binary modem frame body: <from> <to> <rssi> <type> <seqNo> <data 0> ... <data n>
+kFrameHeader = struct.Struct("<BBbBB")
+
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    from urllib3.util.retry import Retry
+
 log = logging.getLogger(__name__)
 
-class BranlyNode:
+gMetrics.describe("branly_emoncms_api_seconds", "histogram", "Response time of emoncms API calls")
+gMetrics.describe("branly_emoncms_errors_total", "counter", "Failed emoncms API calls by HTTP status")
+
+# Contact description of a contact list packet
+ContactInfo = collections.namedtuple("ContactInfo", "id type writeable")
+# Contact value of a contact report or contact value packet
+ContactValue = collections.namedtuple("ContactValue", "id value flags")
+
+class BranlyNode(object):
     """
     A class describing a Branly node
     """
@@ -43,14 +70,18 @@ class BranlyNode:
     """
     Class members
     """
-    id = False       # Node id (int)
-    name = False     # Node name (string)
-    contacts = False # Node contacts (BranlyContact[])
+    __slots__ = (
+        "id",             # Node id (int)
+        "name",           # Node name (string)
+        "contacts",       # Node contacts (BranlyContact[])
+        "__contactIndex", # Contact id -> BranlyContact
+    )
 
     def __init__(self, id, name):
         self.id = id
         self.name = name
         self.contacts = []
+        self.__contactIndex = {}
 
     def __str__(self):
         """
@@ -62,18 +93,29 @@ class BranlyNode:
 
     def addContact(self, contact):
         """
-        Add contact to node
+        Add contact to node, replacing any contact of the same id
         """
+        old = self.__contactIndex.get(contact.id)
+        if old:
+            self.contacts.remove(old)
         self.contacts.append(contact)
+        self.__contactIndex[contact.id] = contact
+
+    def removeContact(self, id):
+        """
+        Remove contact of given id
+        Returns True if the contact was found
+        """
+        contact = self.__contactIndex.pop(id, None)
+        if contact:
+            self.contacts.remove(contact)
+        return contact != None
 
     def findContact(self, id):
         """
         Find BranlyContact of given id or return None if not found
         """
-        for contact in self.contacts:
-            if contact.id == id:
-                return contact
-        return None
+        return self.__contactIndex.get(id)
 
     def setContactValue(self, id, value, flags = None):
         """
@@ -81,7 +123,7 @@ class BranlyNode:
         """
         contact = self.findContact(id)
         if not contact:
-            log.error("Contact %d not found for node %d" % (self.id, id))
+            log.error("Contact %d not found for node %d" % (id, self.id))
         else:
             contact.setValue(value)
             if flags != None:
@@ -89,7 +131,7 @@ class BranlyNode:
 
 
 
-class BranlyContact:
+class BranlyContact(object):
     """
     A class describing a contact of a Branly node
     """
@@ -97,17 +139,20 @@ class BranlyContact:
     """
     Class members
     """
-    id = False    # Contact id (int)
-    type = False  # Contact type (int)
-    name = False  # Contact name (string)
-    flags = False # Contact flags (int)
-    value = False # Contact value (float)
+    __slots__ = (
+        "id",    # Contact id (int)
+        "type",  # Contact type (int)
+        "name",  # Contact name (string)
+        "flags", # Contact flags (int)
+        "value", # Contact value (float)
+    )
 
     def __init__(self, id, type, name, flags):
         self.id = id
         self.type = type
         self.name = name
         self.flags = flags
+        self.value = False
 
     def __str__(self):
         """
@@ -129,7 +174,7 @@ class BranlyContact:
         self.flags = flags
 
 
-class BranlyPacket:
+class BranlyPacket(object):
     """
     A class describing an RF packet received from the Branly Pi RF modem.
     """
@@ -137,124 +182,188 @@ class BranlyPacket:
     """
     Class members
     """
-    valid = False    # Is this packet valid (boolean)
-    fromAddr = False # Node id of transmitter (int)
-    toAddr = False   # Node id of receiver (int)
-    rssi = False     # Receiver RSSI (int)
-    type = False     # Packet type (int)
-    seqNo = False    # Packet sequence number (int)
-    payload = False  # Packet payload (int[])
-
-    def __init__(self, parts):
+    __slots__ = (
+        "valid",         # Is this packet valid (boolean)
+        "fromAddr",      # Node id of transmitter (int)
+        "toAddr",        # Node id of receiver (int)
+        "rssi",          # Receiver RSSI (int)
+        "type",          # Packet type (int)
+        "seqNo",         # Packet sequence number (int)
+        "payload",       # Packet payload (int[])
+        "timestamp",     # Time of arrival at the gateway (float, unix time)
+        "hwVersion",     # Hardware version of hello packet (int)
+        "swVersion",     # Software version of hello packet (int)
+        "mcusrRegister", # Reset cause of hello packet (int)
+        "contactList",   # Contacts of contact list packet (ContactInfo[])
+        "contactValues", # Values of contact report/value packet (ContactValue[])
+        "data",          # Parsed payload of registered packet types (any)
+        "trace",         # Sampled trace of the packet through the gateway (list), see Tracer
+        "modem",         # Name of the modem that received the packet (string)
+    )
+    __decoders = {}      # Packet type -> (name, decode, describe), see registerType
+
+    def __init__(self, parts, timestamp = None):
+        self.__reset(timestamp)
         self.valid = len(parts) == 4
         if self.valid:
             log.debug(parts)
-            self.fromAddr = int(parts[0], 16)
-            self.toAddr = int(parts[1], 16)
-            self.rssi = int(parts[2])
-            payload = parts[3].split(" ")
-            self.valid = len(payload) >= 2
+            try:
+                self.fromAddr = int(parts[0], 16)
+                self.toAddr = int(parts[1], 16)
+                self.rssi = int(parts[2])
+                payload = bytearray.fromhex(parts[3]) # Convert payload to array of integers
+            except ValueError:
+                self.valid = False
         if self.valid:
-            self.type = int(payload[0], 16)
-            self.seqNo = int(payload[1], 16)
-            payload = payload[2:] # Chop packet type and seqNo from payload
-            payload = bytearray.fromhex(" ".join(payload)) # Convert payload to array of integers
-            self.payload = payload
+            self.valid = len(payload) >= 2
         if self.valid:
+            self.type = payload[0]
+            self.seqNo = payload[1]
+            self.payload = payload[2:] # Chop packet type and seqNo from payload
             self.__parsePacket()
 
+    @classmethod
+    def fromFrame(cls, frame, timestamp = None):
+        """
+        Create packet from the body of a binary modem frame (bytearray).
+        Node ids are mapped as in text packets, see textNodeId
+        """
+        packet = cls.__new__(cls)
+        packet.__reset(timestamp)
+        packet.valid = len(frame) >= kFrameHeader.size
+        if packet.valid:
+            (fromAddr, toAddr, packet.rssi, packet.type, packet.seqNo) = kFrameHeader.unpack_from(frame)
+            packet.fromAddr = textNodeId(fromAddr)
+            packet.toAddr = textNodeId(toAddr)
+            packet.payload = frame[kFrameHeader.size:]
+            packet.__parsePacket()
+        return packet
+
+    def __reset(self, timestamp):
+        if timestamp == None:
+            timestamp = time.time()
+        self.timestamp = timestamp
+        self.fromAddr = False
+        self.toAddr = False
+        self.rssi = False
+        self.type = False
+        self.seqNo = False
+        self.payload = False
+        self.data = None
+        self.trace = None
+        self.modem = None
+
     def __str__(self):
         """
         Return string describing this object
         """
-        if self.type == kPacketHello:
-            str = "Hello Packet : src:%d dst:%d cnt:%d rssi:%d HW:0x%02x SW:0x%02x mcusr:0x%02x" % (self.fromAddr, self.toAddr, self.seqNo, self.rssi, self.hwVersion, self.swVersion, self.mcusrRegister)
-        elif self.type == kPacketPing:
-            str = "Ping Packet : src:%d dst:%d cnt:%d rssi:%d " % (self.fromAddr, self.toAddr, self.seqNo, self.rssi)
-        elif self.type == kPacketContactList:
-            str = "ContactList Packet : src:%d dst:%d cnt:%d rssi:%d " % (self.fromAddr, self.toAddr, self.seqNo, self.rssi)
-            for contact in self.contactList:
-                writeable = ""
-                if contact["writeable"]:
-                    writeable = "writeable"
-                str = str + "\n  id:%s type:%d %s" % (contact["id"], contact["type"], writeable)
-        elif self.type == kPacketContactReport:
-            str = "Contact Report Packet : src:%d dst:%d cnt:%d rssi:%d " % (self.fromAddr, self.toAddr, self.seqNo, self.rssi)
-            for contact in self.contactValues:
-                str = str + "\n  id:%s value:%.1f flags:%d" % (contact["id"], contact["value"], contact["flags"])
-        elif self.type == kPacketContactValue:
-            str = "Contact Value Packet : src:%d dst:%d cnt:%d rssi:%d " % (self.fromAddr, self.toAddr, self.seqNo, self.rssi)
-            for contact in self.contactValues:
-                str = str + "\n  id:%s value:%.1f flags:%d" % (contact["id"], contact["value"], contact["flags"])
-        else:
-            str = "Unknown packet"
+        decoder = BranlyPacket.__decoders.get(self.type)
+        if decoder == None:
+            return "Unknown packet"
+        str = "%s Packet : src:%d dst:%d cnt:%d rssi:%d " % (decoder[0], self.fromAddr, self.toAddr, self.seqNo, self.rssi)
+        if decoder[2]:
+            str = str + decoder[2](self)
         return str
 
 
+    @classmethod
+    def registerType(cls, type, name, decode, describe = None):
+        """
+        Register decoder of given packet type. decode(packet) parses
+        packet.payload, stores the result in the packet and returns False if
+        the payload is invalid. The optional describe(packet) returns a string
+        describing the parsed payload. Packet types not known to the parser
+        slots may keep their result in packet.data.
+        """
+        cls.__decoders[type] = (name, decode, describe)
+
+
     def __parsePacket(self):
         """
         Parse self.payload
         """
-        if self.type == kPacketHello:
-            self.__parseHelloPacket()
-        elif self.type == kPacketPing:
-            self.__parsePingPacket()
-        elif self.type == kPacketContactList:
-            self.__parseContactListPacket()
-        elif self.type == kPacketContactReport:
-            self.__parseContactReportPacket()
-        elif self.type == kPacketContactValue:
-            self.__parseContactValuePacket()
+        decoder = BranlyPacket.__decoders.get(self.type)
+        if decoder:
+            self.valid = decoder[1](self) != False
 
 
-    def __parseHelloPacket(self):
-        self.valid = len(self.payload) == 3
-        if self.valid:
-            self.hwVersion = self.payload[0]
-            self.swVersion = self.payload[1]
-            self.mcusrRegister = self.payload[2]
-          
-
-    def __parsePingPacket(self):
-        self.valid = len(self.payload) == 0
-
-
-    def __parseContactListPacket(self):
-        index = 0
-        self.contactList = []
-        while index < len(self.payload):
-            writeable = (self.payload[index] >> 7) & 1
-            contactId = (self.payload[index] >> 4) & 7
-            contactType = self.payload[index] & 0x0f
-            index = index + 1
-            self.contactList.append({"id":contactId, "type":contactType, "writeable":writeable})
-
-
-    def __parseContactReportPacket(self):
-        index = 0
-        self.contactValues = []
-        while index < len(self.payload):
-            contactFlags = (self.payload[index] >> 6) & 3
-            contactSize = (self.payload[index] >> 4) & 3
-            contactId = self.payload[index] & 0x0f
-            if contactSize == 3:
-                contactValue = int(self.payload[index+1]) | (int(self.payload[index+2]) << 8) | (int(self.payload[index+3]) << 16) | (int(self.payload[index+4]) << 24)
-                index = index + 5
-            else:
-                contactValue = int(self.payload[index+1])
-                index = index + 2
-            self.contactValues.append({"id":contactId, "value":contactValue, "flags":contactFlags})
-            
-
-    def __parseContactValuePacket(self):
-        contactFlags = (self.payload[0] >> 6) & 3
-        contactSize = (self.payload[0] >> 4) & 3
-        contactId = self.payload[0] & 0x0f
-        if contactSize == 3:
-            contactValue = int(self.payload[1]) | (int(self.payload[2]) << 8) | (int(self.payload[3]) << 16) | (int(self.payload[4]) << 24)
-        else:
-            contactValue = int(self.payload[1])
-        self.contactValues = [{"id":contactId, "value":contactValue, "flags":contactFlags}]
+def textNodeId(address):
+    """
+    Return node id of radio address as given by text packets. The modem
+    prints addresses in decimal but they have always been parsed as hex, so
+    node 10 is known as 16. The bc: feeds in the cms use these ids.
+    """
+    return int("%d" % address, 16)
+
+
+"""
+Packet decoders
+"""
+
+kHelloPacket = struct.Struct("<BBB") # HW version, SW version, mcusr
+kContactValueSizes = (struct.Struct("<B"), struct.Struct("<B"), struct.Struct("<B"), struct.Struct("<I")) # Indexed by size bits
+
+def decodeContactValues(payload, maxCount = None):
+    """
+    Return list of ContactValues of payload, or None if it is truncated.
+    Each value is <flags:2 size:2 id:4> followed by 1 byte or, for size 3, a
+    32 bit little endian value.
+    """
+    values = []
+    index = 0
+    length = len(payload)
+    while index < length and (maxCount == None or len(values) < maxCount):
+        header = payload[index]
+        field = kContactValueSizes[(header >> 4) & 3]
+        if index + 1 + field.size > length:
+            return None
+        values.append(ContactValue(header & 0x0f, field.unpack_from(payload, index + 1)[0], (header >> 6) & 3))
+        index += 1 + field.size
+    return values
+
+def decodeHelloPacket(packet):
+    if len(packet.payload) != kHelloPacket.size:
+        return False
+    (packet.hwVersion, packet.swVersion, packet.mcusrRegister) = kHelloPacket.unpack_from(packet.payload)
+
+def describeHelloPacket(packet):
+    return "HW:0x%02x SW:0x%02x mcusr:0x%02x" % (packet.hwVersion, packet.swVersion, packet.mcusrRegister)
+
+def decodePingPacket(packet):
+    return len(packet.payload) == 0
+
+def decodeContactListPacket(packet):
+    # Each contact is <writeable:1 id:3 type:4>
+    packet.contactList = [ContactInfo((b >> 4) & 7, b & 0x0f, (b >> 7) & 1) for b in packet.payload]
+
+def describeContactList(packet):
+    str = ""
+    for contact in packet.contactList:
+        writeable = ""
+        if contact.writeable:
+            writeable = "writeable"
+        str = str + "\n  id:%s type:%d %s" % (contact.id, contact.type, writeable)
+    return str
+
+def decodeContactReportPacket(packet):
+    packet.contactValues = decodeContactValues(packet.payload)
+    return packet.contactValues != None
+
+def decodeContactValuePacket(packet):
+    packet.contactValues = decodeContactValues(packet.payload, 1)
+    return packet.contactValues != None and len(packet.contactValues) == 1
+
+def describeContactValues(packet):
+    str = ""
+    for contact in packet.contactValues:
+        str = str + "\n  id:%s value:%.1f flags:%d" % (contact.id, contact.value, contact.flags)
+    return str
+
+BranlyPacket.registerType(kPacketHello, "Hello", decodeHelloPacket, describeHelloPacket)
+BranlyPacket.registerType(kPacketPing, "Ping", decodePingPacket)
+BranlyPacket.registerType(kPacketContactList, "ContactList", decodeContactListPacket, describeContactList)
+BranlyPacket.registerType(kPacketContactReport, "Contact Report", decodeContactReportPacket, describeContactValues)
+BranlyPacket.registerType(kPacketContactValue, "Contact Value", decodeContactValuePacket, describeContactValues)
 
 
 
@@ -270,12 +379,56 @@ class Emoncms:
     apiWriteKey = False     # API write key
     nodes = False           # Known nodes (BranlyNode[])
     lastHttpCode = False    # HTTP response code of last API call
-    lastPacketSeqNo = False # Sequence of last received packet
+    timeout = False         # (connect, read) timeout of API calls (seconds)
+    session = False         # Persistent HTTP session (requests.Session)
+    bulkMode = False        # Post values in batches using input/bulk.json (boolean)
+    bulkMaxSamples = 100    # Flush bulk buffer when this many samples are pending (int)
+    bulkMaxDelay = 10       # Flush bulk buffer when the oldest sample is this old (seconds)
+    bulkMaxPending = 10000  # Max samples kept while the cms is unreachable (int)
+    bulkMaxBackoff = 300    # Max time between retries of a failed bulk post (seconds)
+    provisionWorkers = 4    # Threads creating inputs and feeds in the background (int)
+    feedInterval = 10       # Interval of the feeds created (seconds)
 #    __cmsPrecision = 2      # Precision of values posted to emoncms
 
-    def __init__(self, serverAddress, apiWriteKey):
+    def __init__(self, serverAddress, apiWriteKey, timeout = (3.05, 10), retries = 3, backoff = 0.5, poolSize = 4, provisionWorkers = 4):
+        """
+        API calls share one keep-alive session holding at most poolSize
+        connections. Failed connects and 5xx responses are retried up to
+        retries times, sleeping backoff * 2^n seconds between attempts.
+        New inputs and contacts are provisioned by provisionWorkers threads.
+        """
         self.serverAddress = serverAddress
         self.apiWriteKey = apiWriteKey
+        self.nodes = []
+        self.__nodeIndex = {}            # Node id -> BranlyNode
+        self.__contactIndex = {}         # (node id, contact id) -> BranlyContact
+        self.__nodesLock = threading.Lock() # Guards the node registry when changed from several threads
+        self.__feeds = None              # Feed id -> (tag, name) of the contact feeds last read from the cms
+        self.__snapshot = set()          # (node id, contact id) of the contacts read from the provisioning cache
+        self.timeout = timeout
+        self.provisionWorkers = provisionWorkers
+        retry = Retry(total = retries, backoff_factor = backoff, status_forcelist = [500, 502, 503, 504])
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = poolSize, max_retries = retry, pool_block = True)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.__bulkSamples = []          # Pending (timestamp, node id, input name, value)
+        self.__bulkLock = threading.Lock() # Guards the bulk buffer when called from several threads
+        self.__flushLock = threading.Lock() # Keeps spooled samples posted in order
+        self.__retryTime = 0             # No bulk post before this time after a failure
+        self.__backoff = 0               # Time to wait after the next failed bulk post (seconds)
+        self.__spool = None              # Write-ahead spool of bulk samples (Spool)
+        self.__filter = None             # Decides which contact values to post (ValueFilter)
+        self.__aggregator = None         # Aggregates contact values before posting (Aggregator)
+        self.__aggregateExtremes = False # Post min and max of aggregates too
+        self.__inputs = {}               # Provisioning cache, (node id, input name) -> (input id, feed id)
+        self.__inputsLock = threading.Lock()
+        self.__cachePath = None          # Provisioning cache file
+        self.__cacheLock = threading.Lock() # Serializes writes of the cache file
+        self.__provisioning = {}         # (node id, input name) -> [job, retry time, buffered (timestamp, value)]
+        self.__provisionLock = threading.Lock()
+        self.__provisionQueue = Queue.Queue() # Keys of inputs to provision
+        self.__provisionThreads = []
 
 
     def __str__(self):
@@ -286,6 +439,13 @@ class Emoncms:
         return str
 
 
+    def close(self):
+        """
+        Close all pooled connections to the cms
+        """
+        self.session.close()
+
+
     def enableDebug(self):
         """
         Enable HTTP debugging
@@ -298,46 +458,191 @@ class Emoncms:
         requests_log.propagate = True        
 
 
+    def enableBulk(self, maxSamples = 100, maxDelay = 10):
+        """
+        Coalesce input values and post them using input/bulk.json. Values are
+        flushed when maxSamples are pending or when the oldest pending value is
+        maxDelay seconds old. Call flush() regularly to honour the delay.
+        """
+        self.bulkMode = True
+        self.bulkMaxSamples = maxSamples
+        self.bulkMaxDelay = maxDelay
+
+
+    def enableProvisioningCache(self, path):
+        """
+        Keep the provisioning cache, mapping node inputs to emoncms input and
+        feed ids, in the file at path so it survives restarts. The file also
+        holds a snapshot of the nodes and their provisioned contacts, which
+        are known right away. Call readBranlyNodes() to reconcile them with
+        the cms.
+        """
+        self.__cachePath = path
+        try:
+            with open(path, "rb") as f:
+                cache = json.load(f)
+            if not "inputs" in cache:
+                cache = {"inputs" : cache, "nodes" : {}} # Written before nodes were cached
+            with self.__inputsLock:
+                for (key, ids) in cache["inputs"].items():
+                    (nodeId, inputName) = key.split(":", 1)
+                    self.__inputs[(int(nodeId), inputName.encode('utf8','ignore'))] = tuple(ids)
+            nodes = []
+            for (nodeId, (name, contacts)) in cache["nodes"].items():
+                node = BranlyNode(int(nodeId), name.encode('utf8','ignore'))
+                for (id, type, name, flags) in contacts:
+                    node.addContact(BranlyContact(id, type, name.encode('utf8','ignore'), flags.encode('utf8','ignore')))
+                    self.__snapshot.add((node.id, id))
+                nodes.append(node)
+            self.__mergeNodes(nodes)
+            log.info("Read %d inputs and %d nodes from %s" % (len(cache["inputs"]), len(nodes), path))
+        except (IOError, ValueError, KeyError, TypeError) as e:
+            log.info("No provisioning cache read from %s : %s" % (path, e))
+
+
+    def enableSpool(self, spool):
+        """
+        Write bulk samples to spool instead of keeping them in memory. Samples
+        are removed from the spool once posted, so they survive cms outages
+        and gateway restarts. Requires bulk mode.
+        """
+        self.__spool = spool
+
+
+    def enableFilter(self, filter):
+        """
+        Only post contact values passing filter, see ValueFilter. Contact
+        values are still updated in memory.
+        """
+        self.__filter = filter
+
+
+    def enableAggregation(self, aggregator, extremes = True):
+        """
+        Post one aggregate of the values of each contact per window of
+        aggregator instead of every value, see Aggregator. The mean is posted
+        to the contact input, timestamped with the start of the window, and if
+        extremes is True min and max to inputs c<contact id>_min and _max.
+        New feeds get the window length as interval. The value filter is not
+        used for aggregated contacts. Call flush() regularly to post the
+        windows of contacts that stopped reporting.
+        """
+        self.__aggregator = aggregator
+        self.__aggregateExtremes = extremes
+        self.feedInterval = aggregator.interval
+
+
+    def flush(self, force = False):
+        """
+        Post pending bulk samples to the cms if the buffer is full, too old or
+        if force is True. Samples are kept for the next flush if the post fails,
+        and no post is tried until a backoff of at least bulkMaxDelay, doubling
+        after each failure, has passed unless force is True.
+        Returns True if all went well
+        """
+        if self.__aggregator:
+            for aggregate in self.__aggregator.expire(time.time(), force):
+                self.__reportAggregate(aggregate)
+        if not force and time.time() < self.__retryTime:
+            return False
+        if self.__spool:
+            return self.__flushSpool(force)
+        with self.__bulkLock:
+            samples = self.__bulkSamples
+            if len(samples) == 0:
+                return True
+            if not force and len(samples) < self.bulkMaxSamples and time.time() - samples[0][0] < self.bulkMaxDelay:
+                return True
+            self.__bulkSamples = []
+        if self.__postBulk(samples):
+            return True
+        with self.__bulkLock:
+            # Put the samples back in front of anything that arrived meanwhile
+            samples.extend(self.__bulkSamples)
+            if len(samples) > self.bulkMaxPending:
+                log.error("Bulk buffer full, dropping %d samples" % (len(samples) - self.bulkMaxPending))
+                samples = samples[-self.bulkMaxPending:]
+            self.__bulkSamples = samples
+        return False
+
+
     def readBranlyNodes(self):
         """
-        Read Branly nodes from the cms and return a list of BranlyNodes
-        """
-        nodes = []
-        curNode = None
-        feeds = self.__apiGet("feed/list.json", {})
-        for f in feeds:
-            if f["tag"] != None:
-                tag = f["tag"].split(":")
-                if len(tag) == 5 and tag[0] == "bc": # Branly Contact
-                    # Tag has the format "bc:<node id>:<contact id>:<type>:<flags>"
-                    # Eg. "bc:2:1:2:r"
-                    #  <node id>    : integer
-                    #  <contact id> : integer
-                    #  <type>       : integer
-                    #  <flags>      : string
-                    c = {}
-                    nodeId = int(tag[1])
-                    if curNode == None:
-                        curNode = BranlyNode(nodeId, "Node names currently not supported")
-                    if curNode == None or curNode.id != nodeId:
-                        nodes.append(curNode)
-                        curNode = BranlyNode(nodeId, "Node names currently not supported")
-
-                    name = f["name"].encode('utf8','ignore')
-                    id = int(tag[2])
-                    type = int(tag[3])
-                    flags = tag[4].encode('utf8','ignore')
-                    contact = BranlyContact(id, type, name, flags)
-    
-                    if f["value"] != None:
-                        contact.setValue(f["value"])
-                    curNode.addContact(contact)
-        
-        if curNode != None:
-            nodes.append(curNode)
-        
-        self.nodes = nodes
-        return nodes
+        Read Branly contact feeds from the cms and reconcile them with the
+        nodes we know of, in place. Feeds are indexed by their bc: tag so the
+        feeds of a node need not be listed together. Only feeds that are new,
+        changed or gone since the last read are looked into. Contacts whose
+        feed is gone, on the first read those of the provisioning cache, are
+        forgotten to be provisioned again, while nodes and contacts only known
+        to us, eg. being provisioned, are kept.
+        Returns list of all BranlyNodes or None if the cms could not be read
+        """
+        j = self.__apiGet("feed/list.json", {})
+        if not isinstance(j, list):
+            log.error("Failed to read feeds from the cms : %s" % j)
+            return None
+        feeds = {}                       # Feed id -> (tag, name) of Branly contact feeds
+        values = {}                      # Feed id -> feed value
+        for f in j:
+            try:
+                if f["tag"] != None and f["tag"].startswith("bc:"):
+                    feeds[int(f["id"])] = (f["tag"], f["name"])
+                    values[int(f["id"])] = f["value"]
+            except (KeyError, ValueError, TypeError, AttributeError):
+                log.error("Malformed feed %s" % f)
+
+        known = self.__feeds or {}
+        changed = [(feedId, feed) for (feedId, feed) in feeds.items() if known.get(feedId) != feed]
+        if self.__feeds != None and len(changed) == 0 and len(feeds) == len(known):
+            return self.nodes # Nothing changed
+
+        nodes = {}                       # Node id -> BranlyNode of changed feeds
+        inputs = {}                      # Feeds of contacts not in the provisioning cache
+        for (feedId, (tag, name)) in changed:
+            contact = self.__parseContactTag(tag, name)
+            if contact == None:
+                continue
+            (nodeId, contact) = contact
+            if values[feedId] != None:
+                contact.setValue(values[feedId])
+            if not nodeId in nodes:
+                nodes[nodeId] = BranlyNode(nodeId, "Node names currently not supported")
+            nodes[nodeId].addContact(contact)
+            if not (nodeId, "c%d" % contact.id) in self.__inputs:
+                inputs[(nodeId, "c%d" % contact.id)] = (None, feedId)
+
+        # Contacts no longer found in any feed, a tag edited in place keeps its contact.
+        # On the first read these are the contacts of the snapshot whose feed
+        # was deleted while we were not running.
+        if self.__feeds == None:
+            before = self.__snapshot
+        else:
+            before = set(self.__contactKeys(known.values()))
+        gone = before - set(self.__contactKeys(feeds.values()))
+
+        self.__feeds = feeds
+        self.__cacheInputs(inputs)
+        self.__readCmsInputs()
+        changes = self.__mergeNodes(nodes.values()) + self.__removeContacts(gone)
+        if changes > 0:
+            log.info("%d changes of nodes and contacts read from the cms, %d of %d feeds looked into" % (changes, len(changed), len(feeds)))
+            self.__saveCache()
+        return self.nodes
+
+
+    def findNode(self, nodeId):
+        """
+        Find BranlyNode of given id or return None if not known to us
+        """
+        return self.__nodeIndex.get(nodeId)
+
+
+    def findContact(self, nodeId, contactId):
+        """
+        Find BranlyContact of given node and contact id or return None if not
+        known to us
+        """
+        return self.__contactIndex.get((nodeId, contactId))
 
 
     def handlePacket(self, packet):
@@ -348,82 +653,77 @@ class Emoncms:
         """
         success = True
         log.debug(packet)
-        if self.lastPacketSeqNo != False:
-            if packet.seqNo == self.lastPacketSeqNo:
-                log.info("Skipping duplicate packet #%d" % packet.seqNo)
-                return True # Per definition, all went well
-        self.lastPacketSeqNo = packet.seqNo
-
-        # Report RSSI and current time stamp to cms
-        if not self.__reportCmsInput(packet.fromAddr, "_time", int(time.time())):
+        # Report RSSI and arrival time stamp to cms
+        if not self.__reportCmsInput(packet.fromAddr, "_time", int(packet.timestamp), False, packet.timestamp):
             return False
-        if not self.__reportCmsInput(packet.fromAddr, "_rssi", packet.rssi, True):
+        if not self.__reportCmsInput(packet.fromAddr, "_rssi", packet.rssi, True, packet.timestamp):
             return False
 
         if packet.type == kPacketHello:
-            log.debug("CMS got %s" % packet)
+            log.debug("CMS got %s", packet)
         elif packet.type == kPacketPing:
-            log.debug("CMS got %s " % packet)
+            log.debug("CMS got %s ", packet)
         elif packet.type == kPacketContactList:
-            node = self.__findNode(packet.fromAddr)
-            if node == None:
-                node = BranlyNode(packet.fromAddr, "New node")
-                log.debug("New node %s" % node)
-                if self.__createCmsNode(node):
-                    self.nodes.append(node)
-                else:
-                    success = False
-
-            # TODO: We currently do not handle contacts changing type
-            for contact in packet.contactList:
-                newContact = node.findContact(contact["id"])
-                if newContact == None:
-                    if contact["writeable"]:
-                        flags = "w"
-                    else:
-                        flags = "r"
-                    newContact = BranlyContact(contact["id"], contact["type"], "New contact", flags)
-                    log.debug("New contact: %s" % newContact)
-                    if self.__createCmsNodeContact(node, newContact):
-                        node.addContact(newContact)
+            with self.__nodesLock:
+                node = self.findNode(packet.fromAddr)
+                if node == None:
+                    node = BranlyNode(packet.fromAddr, "New node")
+                    log.debug("New node %s", node)
+                    if self.__createCmsNode(node):
+                        self.nodes.append(node)
+                        self.__nodeIndex[node.id] = node
                     else:
                         success = False
 
+                # TODO: We currently do not handle contacts changing type
+                for contact in packet.contactList:
+                    newContact = self.findContact(node.id, contact.id)
+                    if newContact == None:
+                        if contact.writeable:
+                            flags = "w"
+                        else:
+                            flags = "r"
+                        newContact = BranlyContact(contact.id, contact.type, "New contact", flags)
+                        log.debug("New contact: %s", newContact)
+                        node.addContact(newContact)
+                        self.__contactIndex[(node.id, newContact.id)] = newContact
+                        self.__createCmsNodeContact(node, newContact)
+
         elif packet.type == kPacketContactReport or packet.type == kPacketContactValue:
-            log.debug("CMS got %s" % packet)
-            node = self.__findNode(packet.fromAddr)
-            if not node:
-                log.error("Got contact values from unknown node %d" % (packet.fromAddr))
+            log.debug("CMS got %s", packet)
+            if not packet.fromAddr in self.__nodeIndex:
+                log.error("Got contact values from unknown node %d", packet.fromAddr)
             else:
                 for contactValue in packet.contactValues:
-                    contact = node.findContact(contactValue["id"])
+                    contact = self.findContact(packet.fromAddr, contactValue.id)
                     if contact == None:
-                        log.error("Got contact value from unknown contact id %d" % (contact.id))
+                        log.error("Got contact value from unknown contact id %d", contactValue.id)
                     else:
-                        log.debug("Contact:%s" % contact)
-                        if self.__reportCmsContact(node.id, contactValue["id"], contactValue["value"], contactValue["flags"]):
-                            node.setContactValue(contactValue["id"], contactValue["value"], contactValue["flags"])
+                        log.debug("Contact:%s", contact)
+                        key = (packet.fromAddr, contact.id)
+                        if self.__aggregator:
+                            aggregate = self.__aggregator.add(key, contactValue.value, packet.timestamp)
+                            reported = aggregate == None or self.__reportAggregate(aggregate)
+                        elif self.__filter and not self.__filter.check(key, contactValue.value, packet.timestamp):
+                            reported = True # Not worth posting
                         else:
+                            reported = self.__reportCmsContact(packet.fromAddr, contact.id, contactValue.value, contactValue.flags, packet.timestamp)
+                        if reported:
+                            contact.setValue(contactValue.value)
+                            contact.setFlags(contactValue.flags)
+                        else:
+                            if self.__filter:
+                                self.__filter.forget(key)
                             success = False
 
         else:
-            log.error("Unknown packet type %d" % (packet.type))
+            log.error("Unknown packet type %d", packet.type)
 
         return success
 
 
     """ Private methods below """
 
-    def __findNode(self, branlyNodeId):
-        """
-        Find given Branly node id or return None if not known to us
-        """
-        for node in self.nodes:
-            if node.id == branlyNodeId:
-                return node
-        return None
-
-
     def __createCmsNode(self, node):
         """
         Create node in the cms.
@@ -436,69 +736,301 @@ class Emoncms:
 
     def __createCmsNodeContact(self, node, contact):
         """
-        Create contact for given node in the cms.
+        Create contact for given node in the cms, in the background. Values
+        of the contact reported meanwhile are buffered until it has a feed.
         Note that we at this point do not know the value of the contact
+        """
+        # bc:NODE ID:CONTACT ID:TYPE:FLAGS
+        tag = "bc:%d:%d:%d:%s" % (node.id, contact.id, contact.type, contact.flags)
+        key = (node.id, "c%d" % contact.id)
+        if not key in self.__inputs:
+            self.__provisionLater(key, (node.id, key[1], 0, "New contact", tag, "New contact"))
+
+
+    def __provisionInput(self, nodeId, inputName, value, feedName, feedTag, description = None):
+        """
+        Make sure the named input of given node exists and is logged to a
+        feed, creating what is missing. Inputs in the provisioning cache are
+        known to be provisioned and cost no API calls.
         Returns True if all went well
         """
-        success = False
-        j = self.__postInput(node.id, contact.id, 0)
-        log.debug("postInput %s" % j)
-        if j and "success" in j and "created" in j and "idlist" in j and len(j["idlist"]) > 0 and j["success"]:
-            # Create feed for contact
+        key = (nodeId, inputName)
+        if key in self.__inputs:
+            return True
+        j = self.__postInputNamed(nodeId, inputName, value)
+        if not self.__succeeded(j):
+            log.error("postInput failed : %s" % j)
+            return False
+        if j.get("created") and len(j.get("idlist", [])) > 0:
             emonCmsInputId = j["idlist"][0]
-            j = self.__createFeed(emonCmsInputId)
-            log.debug(j)
-            if j and "success" in j and "feedid" in j:
-                emonCmsFeedId = j["feedid"]
-                j = self.__createProcess(emonCmsInputId, emonCmsFeedId)
-                log.debug(j)
-                if j and "success" in j and j["success"]:
-                    j = self.__setInputProperties(emonCmsInputId, "c%d"%contact.id, "New contact")
-                    log.debug(j)
-                    if j and "success" in j and j["success"]:
-                        # bc:NODE ID:CONTACT ID:TYPE:FLAGS
-                        j = self.__setFeedProperties(emonCmsFeedId, "New contact", "bc:%d:%d:%d:%s" % (node.id, contact.id, contact.type, contact.flags))
-                        log.debug(j)
-                        if j and "success" in j:
-                            success = j["success"]
         else:
-            log.error("postInput failed : %s" % j)
-        
-        return success
+            # The input existed already and may have a feed
+            inputs = self.__readCmsInputs()
+            if key in self.__inputs:
+                return True
+            if not key in inputs:
+                log.error("Input %s of node %d not found in the cms" % (inputName, nodeId))
+                return False
+            emonCmsInputId = inputs[key][0]
+
+        j = self.__createFeed(emonCmsInputId)
+        log.debug(j)
+        if not self.__succeeded(j) or not "feedid" in j:
+            return False
+        emonCmsFeedId = j["feedid"]
+        j = self.__createProcess(emonCmsInputId, emonCmsFeedId)
+        log.debug(j)
+        if not self.__succeeded(j):
+            return False
+        if description != None:
+            j = self.__setInputProperties(emonCmsInputId, inputName, description)
+            log.debug(j)
+            if not self.__succeeded(j):
+                return False
+        j = self.__setFeedProperties(emonCmsFeedId, feedName, feedTag)
+        log.debug(j)
+        if not self.__succeeded(j):
+            return False
+        self.__cacheInputs({key : (emonCmsInputId, emonCmsFeedId)})
+        return True
 
 
-    def __reportCmsInput(self, nodeId, inputName, inputValue, createFeed = False):
+    def __provisionLater(self, key, job = None, timestamp = None, value = None):
+        """
+        Provision the input key, (node id, input name), in the background by
+        calling __provisionInput(*job). Different inputs are provisioned in
+        parallel by the worker pool. A value passed while the input is being
+        provisioned is buffered and reported once the input has a feed.
+        Failed provisioning is retried, at most every kProvisionRetryDelay
+        seconds, the next time the input is asked for.
+        Returns False if job is None and the input is not being provisioned
+        """
+        with self.__provisionLock:
+            entry = self.__provisioning.get(key)
+            if entry == None:
+                if job == None:
+                    return False
+                entry = self.__provisioning[key] = [job, 0, []]
+            if value != None:
+                if timestamp == None:
+                    timestamp = time.time()
+                entry[2].append((timestamp, value))
+                if len(entry[2]) > kProvisionMaxBuffered:
+                    del entry[2][0]
+            if time.time() < entry[1]:
+                return True # Being provisioned or failed recently
+            entry[1] = float("inf")
+            while len(self.__provisionThreads) < self.provisionWorkers:
+                thread = threading.Thread(target = self.__provisionWorker)
+                thread.daemon = True
+                thread.start()
+                self.__provisionThreads.append(thread)
+        self.__provisionQueue.put(key)
+        return True
+
+
+    def __provisionWorker(self):
+        """
+        Thread provisioning inputs queued by __provisionLater
+        """
+        while True:
+            key = self.__provisionQueue.get()
+            with self.__provisionLock:
+                job = self.__provisioning[key][0]
+            try:
+                success = self.__provisionInput(*job)
+            except Exception:
+                log.error("Provisioning of input %s of node %d failed" % (key[1], key[0]), exc_info = True)
+                success = False
+            with self.__provisionLock:
+                entry = self.__provisioning[key]
+                if success:
+                    del self.__provisioning[key]
+                else:
+                    entry[1] = time.time() + kProvisionRetryDelay
+            if success:
+                # New values go straight to the cms now that the input is cached
+                for (timestamp, value) in entry[2]:
+                    self.__postValue(key[0], key[1], value, timestamp)
+            else:
+                log.error("Failed to provision input %s of node %d, %d values buffered" % (key[1], key[0], len(entry[2])))
+
+
+    def __readCmsInputs(self):
+        """
+        Read inputs from the cms and add the ones logged to a feed to the
+        provisioning cache. Contact inputs logged to a feed that is gone from
+        the contact feeds last read count as not logged.
+        Returns dict of (node id, input name) -> (input id, feed id or None)
+        """
+        inputs = {}
+        feeds = self.__feeds
+        j = self.__apiGet("input/list.json", {})
+        if not isinstance(j, list):
+            return inputs
+        for i in j:
+            try:
+                key = (int(i["nodeid"]), i["name"].encode('utf8','ignore'))
+                emonCmsFeedId = None
+                # Eg. "1:61,2:12" or "process__log_to_feed:61"
+                for process in (i.get("processList") or "").split(","):
+                    process = process.split(":")
+                    if len(process) == 2 and process[0] in ("1", "process__log_to_feed"):
+                        emonCmsFeedId = int(process[1])
+                        break
+                if feeds != None and key[1][:1] == "c" and key[1][1:].isdigit() and not emonCmsFeedId in feeds:
+                    emonCmsFeedId = None
+                inputs[key] = (int(i["id"]), emonCmsFeedId)
+            except (KeyError, ValueError, TypeError, AttributeError):
+                log.error("Malformed input %s" % i)
+        self.__cacheInputs(dict([(key, ids) for (key, ids) in inputs.items() if ids[1] != None and self.__inputs.get(key) != ids]))
+        return inputs
+
+
+    def __cacheInputs(self, inputs):
+        """
+        Add dict of provisioned inputs, (node id, input name) -> (input id,
+        feed id), to the provisioning cache and save it
+        """
+        if len(inputs) == 0:
+            return
+        with self.__inputsLock:
+            self.__inputs.update(inputs)
+        self.__saveCache()
+
+
+    def __saveCache(self):
+        """
+        Save the provisioning cache and a snapshot of the nodes. Only
+        provisioned contacts are saved, the others are provisioned again when
+        the node next sends its contact list.
+        """
+        if not self.__cachePath:
+            return
+        with self.__inputsLock:
+            inputs = dict([("%d:%s" % k, v) for (k, v) in self.__inputs.items()])
+        with self.__nodesLock:
+            nodes = {}
+            for node in self.nodes:
+                contacts = [[c.id, c.type, c.name, "%s" % c.flags] for c in node.contacts if "%d:c%d" % (node.id, c.id) in inputs]
+                nodes["%d" % node.id] = [node.name, contacts]
+        with self.__cacheLock:
+            try:
+                with open(self.__cachePath + ".tmp", "wb") as f:
+                    json.dump({"inputs" : inputs, "nodes" : nodes}, f, separators = (",", ":"))
+                os.rename(self.__cachePath + ".tmp", self.__cachePath)
+            except (IOError, OSError) as e:
+                log.error("Failed to save provisioning cache : %s" % e)
+
+
+    def __parseContactTag(self, tag, name):
+        """
+        Parse the tag of a Branly contact feed, "bc:<node id>:<contact id>:<type>:<flags>"
+        Eg. "bc:2:1:2:r"
+         <node id>    : integer
+         <contact id> : integer
+         <type>       : integer
+         <flags>      : string
+        Returns (node id, BranlyContact) or None if the tag is malformed
+        """
+        tag = tag.split(":")
+        if len(tag) != 5 or tag[0] != "bc":
+            return None
+        try:
+            contact = BranlyContact(int(tag[2]), int(tag[3]), name.encode('utf8','ignore'), tag[4].encode('utf8','ignore'))
+            return (int(tag[1]), contact)
+        except ValueError:
+            log.error("Malformed contact tag %s" % ":".join(tag))
+            return None
+
+
+    def __contactKeys(self, feeds):
+        """
+        Return list of (node id, contact id) of list of (tag, name) of contact feeds
+        """
+        keys = []
+        for (tag, name) in feeds:
+            contact = self.__parseContactTag(tag, name)
+            if contact != None:
+                keys.append((contact[0], contact[1].id))
+        return keys
+
+
+    def __removeContacts(self, contacts):
+        """
+        Forget list of (node id, contact id) and their provisioned inputs
+        Returns number of contacts removed
+        """
+        removed = 0
+        with self.__nodesLock:
+            for key in contacts:
+                node = self.__nodeIndex.get(key[0])
+                if node and node.removeContact(key[1]):
+                    del self.__contactIndex[key]
+                    removed += 1
+                    log.info("Contact %d of node %d is gone from the cms" % (key[1], key[0]))
+        with self.__inputsLock:
+            for (nodeId, contactId) in contacts:
+                self.__inputs.pop((nodeId, "c%d" % contactId), None)
+        return removed
+
+
+    def __mergeNodes(self, nodes):
+        """
+        Merge list of BranlyNodes into the nodes we know of, adding missing
+        nodes and contacts and updating contacts whose type or name changed
+        Returns number of nodes and contacts added or changed
+        """
+        changes = 0
+        with self.__nodesLock:
+            for node in nodes:
+                known = self.__nodeIndex.get(node.id)
+                if known == None:
+                    known = BranlyNode(node.id, node.name)
+                    self.nodes.append(known)
+                    self.__nodeIndex[node.id] = known
+                    changes += 1
+                for contact in node.contacts:
+                    old = known.findContact(contact.id)
+                    if old == None:
+                        known.addContact(contact)
+                        self.__contactIndex[(node.id, contact.id)] = contact
+                        changes += 1
+                    elif (old.type, old.name) != (contact.type, contact.name):
+                        # Flags are left alone, they follow the values reported by the node
+                        (old.type, old.name) = (contact.type, contact.name)
+                        changes += 1
+                    if old != None and old.value is False:
+                        old.setValue(contact.value)
+        return changes
+
+
+    def __reportCmsInput(self, nodeId, inputName, inputValue, createFeed = False, timestamp = None):
         """
         Report Emoncms input value for given node.
-        Optionally creates feed for input
+        Optionally makes sure the input is logged to a feed. Inputs missing in
+        the provisioning cache are provisioned in the background.
         Returns True if all went well
         """
-        success = False
-        j = self.__postInputNamed(nodeId, inputName, inputValue)
-        if j and "success" in j and "created" in j and j["success"]:
-            if createFeed and j["created"]:
-                emonCmsInputId = j["idlist"][0]
-                j = self.__createFeed(emonCmsInputId)
-                if j and "success" in j and "feedid" in j and j["success"]:
-                    emonCmsFeedId = j["feedid"]
-                    j = self.__createProcess(emonCmsInputId, emonCmsFeedId)
-                    if j and "success" in j and j["success"] and j["success"]:
-                        j = self.__setFeedProperties(emonCmsFeedId, inputName, "")
-                        if j and "success" in j and j["success"]:
-                            j = self.__postInputNamed(nodeId, inputName, inputValue)
-                            if j and "success" in j:
-                                success = j["success"]
-            else: # Don't create feed
-                success = j["success"]
-        return success
+        key = (nodeId, inputName)
+        if createFeed and not key in self.__inputs:
+            # Buffered until the input has a feed
+            return self.__provisionLater(key, (nodeId, inputName, inputValue, inputName, ""), timestamp, inputValue)
+        return self.__postValue(nodeId, inputName, inputValue, timestamp)
 
 
-    def __reportCmsContact(self, nodeId, contactId, contactValue, contactFlags):
+    def __reportCmsContact(self, nodeId, contactId, contactValue, contactFlags, timestamp = None):
         """
         Report contact value for given node in the cms.
         TODO: Handle contactFlags
         Returns True if all went well
         """
+        key = (nodeId, "c%d" % contactId)
+        if not key in self.__inputs and self.__provisionLater(key, None, timestamp, contactValue):
+            return True # Buffered until the contact has a feed
+        if self.bulkMode:
+            self.__queueBulk(timestamp, nodeId, "c%d" % contactId, contactValue)
+            return True
         success = False
         j = self.__postInput(nodeId, contactId, contactValue)
         if j and "success" in j:
@@ -506,21 +1038,152 @@ class Emoncms:
         return success
 
 
-    def __apiCall(self, api, doPost, parameterDict):
+    def __reportAggregate(self, aggregate):
+        """
+        Report Aggregate of a contact in the cms
+        Returns True if all went well
+        """
+        (nodeId, contactId) = aggregate.key
+        success = self.__reportCmsContact(nodeId, contactId, aggregate.mean, None, aggregate.start)
+        if self.__aggregateExtremes:
+            success = self.__reportCmsInput(nodeId, "c%d_min" % contactId, aggregate.min, True, aggregate.start) and success
+            success = self.__reportCmsInput(nodeId, "c%d_max" % contactId, aggregate.max, True, aggregate.start) and success
+        return success
+
+
+    def __postValue(self, nodeId, inputName, value, timestamp = None):
+        """
+        Post input value, or queue it in bulk mode
+        Returns True if all went well
+        """
+        if self.bulkMode:
+            self.__queueBulk(timestamp, nodeId, inputName, value)
+            return True
+        return self.__succeeded(self.__postInputNamed(nodeId, inputName, value))
+
+
+    def __queueBulk(self, timestamp, nodeId, inputName, value):
+        """
+        Queue input value for the next bulk post
+        """
+        if timestamp == None:
+            timestamp = time.time()
+        if self.__spool:
+            self.__spool.append((timestamp, nodeId, inputName, value))
+            full = self.__spool.pending >= self.bulkMaxSamples
+        else:
+            with self.__bulkLock:
+                self.__bulkSamples.append((timestamp, nodeId, inputName, value))
+                full = len(self.__bulkSamples) >= self.bulkMaxSamples
+                if len(self.__bulkSamples) > self.bulkMaxPending:
+                    log.error("Bulk buffer full, dropping %d samples", len(self.__bulkSamples) - self.bulkMaxPending)
+                    del self.__bulkSamples[:-self.bulkMaxPending]
+        # While backing off the periodic flush() retries, new values never wait for the cms
+        if full and time.time() >= self.__retryTime:
+            self.flush()
+
+
+    def __flushSpool(self, force):
+        """
+        Post spooled samples in batches of bulkMaxSamples, oldest first, until
+        the spool is empty or a post fails. At most one flush runs at a time.
+        Returns True if all went well
+        """
+        spool = self.__spool
+        if not self.__flushLock.acquire(False):
+            return True # Another thread is flushing
+        try:
+            spool.sync()
+            oldest = spool.oldest()
+            if oldest == None:
+                if spool.pending == 0:
+                    return True
+                # Only corrupt records left, acked below
+            elif not force and spool.pending < self.bulkMaxSamples and time.time() - oldest[0] < self.bulkMaxDelay:
+                return True
+            while spool.pending > 0:
+                (samples, cursor) = spool.peek(self.bulkMaxSamples)
+                if len(samples) == 0:
+                    if cursor[2] > 0:
+                        spool.ack(cursor) # Corrupt records only
+                        continue
+                    break
+                if not self.__postBulk(samples):
+                    return False
+                spool.ack(cursor)
+            return True
+        finally:
+            self.__flushLock.release()
+
+
+    def __postBulk(self, samples):
+        """
+        Post list of (timestamp, node id, input name, value) in one request.
+        Samples of the same node and second are merged into one bulk entry.
+        Returns True if all went well
+        """
+        # http://localhost/emoncms/input/bulk.json?time=1445000000&data=[[0,10,{"_rssi":-42},{"c1":23.5}],[2,11,{"c2":1}]]
+        # Time of each entry is an offset relative to the time parameter
+        timeRef = int(samples[0][0])
+        entries = []
+        current = {} # (offset, node id) -> (entry, input names in entry)
+        for (timestamp, nodeId, inputName, value) in samples:
+            key = (int(timestamp) - timeRef, nodeId)
+            if not key in current or inputName in current[key][1]:
+                # A repeated input in the same second goes in a new entry
+                current[key] = ([key[0], nodeId], set())
+                entries.append(current[key][0])
+            current[key][0].append({inputName : round(float(value), 2)})
+            current[key][1].add(inputName)
+        params = {"time" : timeRef, "data" : json.dumps(entries, separators=(',', ':'))}
+        success = self.__apiCall("input/bulk.json", True, params, False)
+        if success:
+            log.debug("Posted %d samples in %d bulk entries", len(samples), len(entries))
+            self.__backoff = 0
+            self.__retryTime = 0
+        else:
+            self.__backoff = min(max(self.__backoff * 2, self.bulkMaxDelay), self.bulkMaxBackoff)
+            self.__retryTime = time.time() + self.__backoff
+            log.error("Bulk post of %d samples failed, retrying in %d seconds" % (len(samples), self.__backoff))
+        return success
+
+
+    def __apiCall(self, api, doPost, parameterDict, expectJson = True):
         """
         Perform HTTP GET or POST to the API with given parameters
-        Returns JSON decoded response data or False in case of errors
+        Returns JSON decoded response data or False in case of errors. If
+        expectJson is False, True is returned if the response is "ok", as
+        emoncms reports errors of eg. input/bulk.json as text with status 200.
         The last HTTP response code can be found in the lastHttpCode member
         """
         ret = False
         parameterDict["apikey"] = self.apiWriteKey
         url = "%s/%s" % (self.serverAddress, api)
-        if doPost:
-            r = requests.get(url, data=parameterDict)
-        else:
-            r = requests.get(url, params=parameterDict)
+        start = time.time()
+        if gTracer.enabled:
+            gTracer.mark(api)
+        try:
+            if doPost:
+                r = self.session.post(url, data=parameterDict, timeout=self.timeout)
+            else:
+                r = self.session.get(url, params=parameterDict, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            self.lastHttpCode = False
+            log.error("%s failed for %s : %s" % (api, url, e))
+            gMetrics.inc("branly_emoncms_errors_total", {"api" : api, "code" : "exception"})
+            return False
+        gMetrics.observe("branly_emoncms_api_seconds", {"api" : api}, time.time() - start)
+        if gTracer.enabled:
+            gTracer.mark("%s done" % api)
         self.lastHttpCode = r.status_code
-        if self.lastHttpCode == 200:
+        if self.lastHttpCode != 200:
+            gMetrics.inc("branly_emoncms_errors_total", {"api" : api, "code" : self.lastHttpCode})
+        if self.lastHttpCode == 200 and not expectJson:
+            if r.text.strip() == "ok":
+                return True
+            log.error("%s failed with '%s'" % (api, r.text.strip()[:200]))
+            gMetrics.inc("branly_emoncms_errors_total", {"api" : api, "code" : "rejected"})
+        elif self.lastHttpCode == 200:
             try:
                 ret = r.json()
             except ValueError:
@@ -532,6 +1195,12 @@ class Emoncms:
             log.error("API call to %s failed with '%s' for %s" % (api, ret["message"], r.url))
         return ret
 
+    def __succeeded(self, j):
+        """
+        Return True if j is a JSON decoded API response reporting success
+        """
+        return isinstance(j, dict) and j.get("success") == True
+
     def __apiGet(self, api, parameterDict):
         """
         Perform HTTP GET to the API with given parameters
@@ -566,7 +1235,7 @@ class Emoncms:
         """
         # http://localhost/emoncms/input/post.json?node=999&json={contact1:200}
         # {"success":true,"result":true,"created":true,"id":72}
-        params = {"node" : nodeId, "json" : "%s:%.2f}" % (inputName, value)}
+        params = {"node" : nodeId, "json" : "{%s:%.2f}" % (inputName, value)}
         return self.__apiGet("input/post.json", params)
 
 
@@ -577,7 +1246,7 @@ class Emoncms:
         """
         # http://localhost/emoncms/feed/create.json?name=c1_feed&datatype=1&engine=4&options={"interval":"10"}
         # {"success":true,"feedid":61,"result":true}
-        params = {"name" : "New contact", "datatype" : 1, "engine" : 4, "options" : "{\"interval\":\"10\"}"}
+        params = {"name" : "New contact", "datatype" : 1, "engine" : 4, "options" : "{\"interval\":\"%d\"}" % self.feedInterval}
         return self.__apiGet("feed/create.json", params)
 
 
@@ -0,0 +1,194 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Non-blocking logging. Threads logging through a QueueHandler only put the
+record on a queue, a QueueListener thread formats and hands records to the
+real handlers in batches. Log with arguments, log.debug("Got %s", packet),
+rather than formatting the message yourself, so that records dropped or
+below the level are never formatted.
+"""
+
+import time
+import Queue
+import logging
+import threading
+
+kMaxBuckets = 1000  # Prune idle messages when rate limiting this many
+
+class QueueHandler(logging.Handler):
+    """
+    Puts records on a bounded queue for a QueueListener. Records are dropped
+    when the queue is full, the logging thread never blocks.
+    """
+
+    """
+    Class members
+    """
+    queue = False     # Records for the listener (Queue.Queue)
+    dropped = 0       # Number of records dropped as the queue was full (int)
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+
+class QueueListener:
+    """
+    Thread taking records from a queue and passing them to handlers. Records
+    are handled in batches of up to batchSize, the handlers being flushed
+    after each batch. After a batch smaller than batchSize the thread waits
+    interval seconds for more records to arrive, a full batch is followed
+    by the next one right away.
+    """
+
+    """
+    Class members
+    """
+    queue = False     # Records to handle (Queue.Queue)
+    handlers = False  # Handlers of the records (logging.Handler[])
+    batchSize = 100   # Max records handled before flushing the handlers (int)
+    interval = 0.1    # Time waited after a batch that was not full (seconds)
+
+    def __init__(self, queue, handlers, batchSize = 100, interval = 0.1):
+        self.queue = queue
+        self.handlers = handlers
+        self.batchSize = batchSize
+        self.interval = interval
+        self.__thread = None
+
+    def start(self):
+        """
+        Start handling records
+        """
+        self.__thread = threading.Thread(target = self.__run, name = "log-listener")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Handle the records queued so far and stop
+        """
+        if self.__thread:
+            self.queue.put(None)
+            self.__thread.join()
+            self.__thread = None
+
+
+    """ Private methods below """
+
+    def __run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for record in batch:
+                if record == None:
+                    continue
+                for handler in self.handlers:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+            for handler in self.handlers:
+                handler.flush()
+            if None in batch:
+                return
+            if len(batch) < self.batchSize:
+                time.sleep(self.interval)
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """
+    A StreamHandler leaving flushing to the QueueListener, once per batch
+    """
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + "\n")
+        except Exception:
+            self.handleError(record)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most rate records per second of each message, with bursts of
+    up to burst records. Messages are told apart by the line logging them, so
+    log.error("Invalid message '%s'", line) is limited no matter the line. The
+    next record of a message passing after some were suppressed tells how
+    many.
+    """
+
+    """
+    Class members
+    """
+    rate = False      # Records per second and message (float)
+    burst = False     # Max records in a burst (int)
+    suppressed = 0    # Number of records suppressed (int)
+
+    def __init__(self, rate = 10, burst = 50):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.burst = burst
+        self.__buckets = {}   # (file, line number) -> [tokens, time of last record, records suppressed]
+        self.__lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        with self.__lock:
+            bucket = self.__buckets.get(key)
+            if bucket == None:
+                if len(self.__buckets) >= kMaxBuckets:
+                    self.__prune(now)
+                bucket = self.__buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed += 1
+                return False
+            bucket[0] -= 1
+            suppressed = bucket[2]
+            bucket[2] = 0
+        if suppressed:
+            record.msg = "%s (%d similar messages suppressed)" % (record.msg, suppressed)
+        return True
+
+
+    """ Private methods below """
+
+    def __prune(self, now):
+        """
+        Forget messages that have been quiet long enough to have a full bucket
+        """
+        for (key, bucket) in list(self.__buckets.items()):
+            if bucket[2] == 0 and bucket[0] + (now - bucket[1]) * self.rate >= self.burst:
+                del self.__buckets[key]
@@ -0,0 +1,158 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import bisect
+import threading
+
+kDefaultBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Seconds
+
+class Metrics:
+    """
+    A registry of counters, gauges and histograms rendered in the Prometheus
+    text format. Metrics are created when first used and identified by name
+    and an optional dict of labels. Describe metrics with describe() to give
+    them a type and help text.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__metrics = {}   # Name -> [type, help, buckets, {label string -> value}]
+        self.__collectors = []
+
+    def describe(self, name, type, help, buckets = kDefaultBuckets):
+        """
+        Declare metric name of type "counter", "gauge" or "histogram"
+        """
+        with self.__lock:
+            metric = self.__metric(name, type)
+            metric[0] = type
+            metric[1] = help
+            metric[2] = buckets
+
+    def addCollector(self, collect):
+        """
+        Call collect(metrics) before rendering, to update gauges of state kept
+        elsewhere
+        """
+        self.__collectors.append(collect)
+
+    def inc(self, name, labels = None, value = 1):
+        """
+        Add value to counter name
+        """
+        key = self.__labels(labels)
+        with self.__lock:
+            values = self.__metric(name, "counter")[3]
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        """
+        Set gauge name to value
+        """
+        key = self.__labels(labels)
+        with self.__lock:
+            self.__metric(name, "gauge")[3][key] = value
+
+    def observe(self, name, labels, value):
+        """
+        Add observation value to histogram name
+        """
+        key = self.__labels(labels)
+        with self.__lock:
+            metric = self.__metric(name, "histogram")
+            histogram = metric[3].get(key)
+            if histogram == None:
+                histogram = metric[3][key] = [[0] * len(metric[2]), 0, 0.0] # Bucket counts, count, sum
+            index = bisect.bisect_left(metric[2], value)
+            if index < len(metric[2]):
+                histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text format
+        """
+        for collect in self.__collectors:
+            collect(self)
+        lines = []
+        with self.__lock:
+            for name in sorted(self.__metrics.keys()):
+                (type, help, buckets, values) = self.__metrics[name]
+                if help:
+                    lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, type))
+                for key in sorted(values.keys()):
+                    if type == "histogram":
+                        (counts, count, sum) = values[key]
+                        cumulative = 0
+                        for (bound, n) in zip(buckets, counts):
+                            cumulative += n
+                            lines.append("%s_bucket%s %d" % (name, self.__join(key, 'le="%s"' % bound), cumulative))
+                        lines.append("%s_bucket%s %d" % (name, self.__join(key, 'le="+Inf"'), count))
+                        lines.append("%s_count%s %d" % (name, key, count))
+                        lines.append("%s_sum%s %s" % (name, key, self.__format(sum)))
+                    else:
+                        lines.append("%s%s %s" % (name, key, self.__format(values[key])))
+        return "\n".join(lines) + "\n"
+
+    def afterFork(self):
+        """
+        Replace the lock in a child process forked while other threads ran,
+        as one of them may have held it
+        """
+        self.__lock = threading.Lock()
+
+
+    """ Private methods below """
+
+    def __metric(self, name, type):
+        metric = self.__metrics.get(name)
+        if metric == None:
+            metric = self.__metrics[name] = [type, None, kDefaultBuckets, {}]
+        return metric
+
+    def __labels(self, labels):
+        """
+        Return label string of dict labels, eg. '{node="16"}'
+        """
+        if not labels:
+            return ""
+        pairs = []
+        for name in sorted(labels.keys()):
+            value = ("%s" % labels[name]).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            pairs.append('%s="%s"' % (name, value))
+        return "{%s}" % ",".join(pairs)
+
+    def __format(self, value):
+        if isinstance(value, float):
+            return repr(value)
+        return "%d" % value
+
+    def __join(self, key, label):
+        if key == "":
+            return "{%s}" % label
+        return key[:-1] + "," + label + "}"
+
+
+gMetrics = Metrics() # Metrics of the gateway
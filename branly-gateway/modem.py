@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Serial link to the BranlyPi modem
+
+The modem sends text lines, ":P:...;" packets and "# ..." debug messages. When
+asked to by kModemRequestBinary it instead sends packets as binary frames:
+
+  <0xa5> <length> <from> <to> <rssi> <data 0> ... <data n> <crc lo> <crc hi>
+
+<length> counts the bytes from <from> to <data n> and <rssi> is signed. The
+CRC is CRC-16/CCITT (avr-libc _crc_ccitt_update, init 0xffff) of <length> to
+<data n>. Debug messages are always sent as text. A modem without binary
+support ignores the request and keeps sending text, so both are decoded.
+"""
+
+import re
+import struct
+import logging
+
+kFrameSync = 0xa5
+kFrameMinLength = 5           # from, to, rssi, type, seqNo
+kFrameMaxLength = 3 + 64      # RFM69 max payload
+kFrameCrc = struct.Struct("<H")
+kMaxLineLength = 256          # Longer text lines are garbage
+kTextStart = bytearray(":#")  # First byte of text messages
+kPacketStart = ord(":")       # First byte of text packets
+kWhitespace = bytearray(" \t\r\n")
+kLineEnd = bytearray("\r\n")
+kNonText = re.compile(r"[^\t\x20-\x7e]") # Ends a text message
+
+kModemRequestBinary = "B"     # Ask the modem for binary frames
+kModemRequestText = "T"       # Ask the modem for text packets
+kModemBootBanner = "# FRQ:"   # First line sent after a modem reset
+
+log = logging.getLogger(__name__)
+
+def __crcTable():
+    table = []
+    for i in range(256):
+        crc = i
+        for bit in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc = crc >> 1
+        table.append(crc)
+    return table
+
+kCrcTable = __crcTable()
+
+def crc16(data, start, end, crc = 0xffff):
+    """
+    Return CRC-16/CCITT of data[start:end], data being a bytearray
+    """
+    table = kCrcTable
+    for i in range(start, end):
+        crc = (crc >> 8) ^ table[(crc ^ data[i]) & 0xff]
+    return crc
+
+def encodeFrame(fromAddr, toAddr, rssi, payload):
+    """
+    Return binary frame of given packet, as sent by the modem
+    """
+    frame = bytearray([kFrameSync, 3 + len(payload), fromAddr & 0xff, toAddr & 0xff, rssi & 0xff])
+    frame.extend(payload)
+    frame.extend(kFrameCrc.pack(crc16(frame, 1, len(frame))))
+    return frame
+
+
+class ModemDecoder:
+    """
+    Splits the byte stream from the modem into messages. Text lines are
+    returned as stripped strings and binary frames as a bytearray holding
+    <from> to <data n>. Bytes may be fed in chunks of any size, partial
+    messages are kept until the rest arrives. Packets end at their ';' and
+    are returned without waiting for the newline that follows. A text start
+    byte followed by anything but printable ASCII up to the line end is a
+    stray byte, eg. in a frame cut short, and is skipped alone so the frames
+    after it are found.
+    """
+
+    """
+    Class members
+    """
+    buffer = False    # Received bytes not yet decoded (bytearray)
+    frames = 0        # Number of valid frames (int)
+    lines = 0         # Number of text lines (int)
+    crcErrors = 0     # Number of frames with bad CRC (int)
+    garbage = 0       # Number of bytes skipped while looking for a message (int)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "ModemDecoder: frames:%d lines:%d crcErrors:%d garbage:%d" % (self.frames, self.lines, self.crcErrors, self.garbage)
+        return str
+
+    def feed(self, data):
+        """
+        Add received bytes and return list of complete messages
+        """
+        buffer = self.buffer
+        buffer.extend(data)
+        messages = []
+        view = memoryview(buffer)
+        length = len(buffer)
+        pos = 0
+        while pos < length:
+            if buffer[pos] == kFrameSync:
+                if length - pos < 2:
+                    break
+                frameLength = buffer[pos + 1]
+                if frameLength < kFrameMinLength or frameLength > kFrameMaxLength:
+                    self.garbage += 1
+                    pos += 1
+                    continue
+                end = pos + 2 + frameLength
+                if end + 2 > length:
+                    break # Wait for the rest of the frame
+                if crc16(buffer, pos + 1, end) != kFrameCrc.unpack_from(view, end)[0]:
+                    self.crcErrors += 1
+                    pos += 1 # Resync on the next sync byte
+                    continue
+                messages.append(bytearray(view[pos + 2:end]))
+                self.frames += 1
+                pos = end + 2
+            elif buffer[pos] in kTextStart:
+                limit = min(length, pos + kMaxLineLength)
+                match = kNonText.search(buffer, pos, limit)
+                stop = limit
+                if match:
+                    stop = match.start()
+                end = -1
+                if buffer[pos] == kPacketStart:
+                    end = buffer.find(";", pos, stop)
+                    if end >= 0:
+                        end += 1 # Keep the ';'
+                if end < 0 and match:
+                    if not buffer[stop] in kLineEnd:
+                        self.garbage += 1
+                        pos += 1 # Not text, look for a frame from the next byte
+                        continue
+                    end = stop
+                if end < 0:
+                    if length - pos >= kMaxLineLength:
+                        self.garbage += kMaxLineLength
+                        pos += kMaxLineLength
+                        continue
+                    break # Wait for the rest of the line
+                line = view[pos:end].tobytes().rstrip()
+                messages.append(line)
+                self.lines += 1
+                pos = end # A line end left here is skipped as whitespace
+            else:
+                if not buffer[pos] in kWhitespace:
+                    self.garbage += 1
+                pos += 1
+        del view
+        del buffer[:pos]
+        return messages
@@ -0,0 +1,137 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import Queue
+import collections
+import logging
+
+# Overflow policies
+kOverflowBlock = "block"            # Block the producer until there is room
+kOverflowDropOldest = "drop-oldest" # Drop the oldest queued item
+kOverflowDropNewest = "drop-newest" # Drop the item being put
+kOverflowCoalesce = "coalesce"      # Replace a queued item of the same key, else drop oldest
+
+log = logging.getLogger(__name__)
+
+class RXQueue(Queue.Queue):
+    """
+    A bounded Queue.Queue with a configurable policy for what to do when the
+    queue is full. Counters for queued, dropped and coalesced items are kept.
+
+    The coalesce policy needs keyFunc(item) returning a hashable key for items
+    that may replace each other (eg. the value of one contact) or None for
+    items that may not. An item replacing a queued one keeps its place in the
+    queue.
+    """
+
+    """
+    Class members
+    """
+    policy = False    # Overflow policy (kOverflow*)
+    keyFunc = False   # Coalescing key of an item, or None (function)
+    queued = 0        # Number of items accepted (int)
+    dropped = 0       # Number of items dropped (int)
+    coalesced = 0     # Number of items replaced by a newer one (int)
+
+    def __init__(self, maxsize, policy = kOverflowDropOldest, keyFunc = None):
+        if not policy in (kOverflowBlock, kOverflowDropOldest, kOverflowDropNewest, kOverflowCoalesce):
+            raise ValueError("Unknown overflow policy '%s'" % policy)
+        if policy == kOverflowCoalesce and keyFunc == None:
+            raise ValueError("The coalesce policy needs a key function")
+        Queue.Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.keyFunc = keyFunc
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "RXQueue: size:%d/%d policy:%s queued:%d dropped:%d coalesced:%d" % (self.qsize(), self.maxsize, self.policy, self.queued, self.dropped, self.coalesced)
+        return str
+
+    def stats(self):
+        """
+        Return dict of queue counters
+        """
+        with self.mutex:
+            return {"size" : self._qsize(), "queued" : self.queued, "dropped" : self.dropped, "coalesced" : self.coalesced}
+
+    def put(self, item, block = True, timeout = None):
+        """
+        Put item in the queue. Only the block policy ever blocks.
+        """
+        if self.policy == kOverflowBlock or self.maxsize <= 0:
+            return Queue.Queue.put(self, item, block, timeout)
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                if self.policy == kOverflowDropNewest:
+                    self.dropped += 1
+                    return
+                if self.policy == kOverflowCoalesce and self.__coalesce(item):
+                    return
+                self._get()
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+
+    """ Queue.Queue overrides, called with self.mutex held """
+
+    def _init(self, maxsize):
+        self.queue = collections.deque() # Slots, [item, key]
+        self.__slots = {}                # key -> slot of latest queued item with that key
+
+    def _qsize(self, len = len):
+        return len(self.queue)
+
+    def _put(self, item):
+        key = None
+        if self.policy == kOverflowCoalesce:
+            key = self.keyFunc(item)
+        slot = [item, key]
+        if key != None:
+            self.__slots[key] = slot
+        self.queue.append(slot)
+        self.queued += 1
+
+    def _get(self):
+        slot = self.queue.popleft()
+        if slot[1] != None and self.__slots.get(slot[1]) is slot:
+            del self.__slots[slot[1]]
+        return slot[0]
+
+
+    """ Private methods below """
+
+    def __coalesce(self, item):
+        """
+        Replace the queued item having the same key as item.
+        Returns True if an item was replaced
+        """
+        key = self.keyFunc(item)
+        if key == None or not key in self.__slots:
+            return False
+        self.__slots[key][0] = item
+        self.coalesced += 1
+        return True
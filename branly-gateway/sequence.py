@@ -0,0 +1,141 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import logging
+
+log = logging.getLogger(__name__)
+
+class SequenceTracker:
+    """
+    Tracks the 8 bit sequence numbers of packets from each node to drop
+    retransmitted duplicates and to count packets lost.
+
+    For each node the highest sequence number seen and a bit mask of the
+    window sequence numbers before it are kept. A packet up to half the
+    sequence space ahead of the highest is new and any numbers skipped are
+    counted as lost. A packet inside the window behind it is a duplicate if
+    seen before, otherwise a late packet no longer counted as lost if it was
+    skipped by a packet ahead of it. A second mask of the window remembers
+    which numbers were counted as lost that way. A packet
+    further behind means the node restarted and tracking starts over.
+    """
+
+    """
+    Class members
+    """
+    window = False    # Number of sequence numbers remembered per node (int)
+    modulo = False    # Size of the sequence number space (int)
+    duplicates = 0    # Number of duplicates dropped from all nodes (int)
+
+    def __init__(self, window = 32, modulo = 256):
+        if window < 1 or window > modulo / 2:
+            raise ValueError("Window must be 1 to %d" % (modulo / 2))
+        self.window = window
+        self.modulo = modulo
+        self.__nodes = {}  # Node id -> [highest seqNo, seen mask, received, lost, duplicates, lost mask]
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "SequenceTracker: nodes:%d window:%d duplicates:%d" % (len(self.__nodes), self.window, self.duplicates)
+        return str
+
+    def check(self, nodeId, seqNo):
+        """
+        Record packet seqNo from node nodeId.
+        Returns False if the packet is a duplicate and should be dropped
+        """
+        node = self.__nodes.get(nodeId)
+        if node == None:
+            self.__nodes[nodeId] = [seqNo, 1, 1, 0, 0, 0]
+            return True
+        ahead = (seqNo - node[0]) % self.modulo
+        if ahead == 0:
+            return self.__duplicate(node)
+        if ahead < self.modulo / 2:
+            mask = (1 << self.window) - 1
+            node[0] = seqNo
+            node[1] = ((node[1] << ahead) | 1) & mask
+            node[2] += 1
+            node[3] += ahead - 1
+            node[5] = ((node[5] << ahead) | ((1 << ahead) - 2)) & mask # Skipped numbers, bits 1 to ahead - 1
+            return True
+        behind = self.modulo - ahead
+        if behind < self.window:
+            bit = 1 << behind
+            if node[1] & bit:
+                return self.__duplicate(node)
+            node[1] |= bit
+            node[2] += 1
+            if node[5] & bit:
+                node[5] &= ~bit
+                node[3] -= 1 # Counted as lost when skipped
+            return True
+        log.info("Node %d restarted its sequence at %d (was %d)" % (nodeId, seqNo, node[0]))
+        return self.restart(nodeId, seqNo)
+
+    def restart(self, nodeId, seqNo):
+        """
+        Restart the sequence of node nodeId at packet seqNo, eg. when the node
+        says hello after booting. Counters are kept.
+        Returns False if seqNo is the last packet seen, ie. a retransmission
+        """
+        node = self.__nodes.get(nodeId)
+        if node == None:
+            self.__nodes[nodeId] = [seqNo, 1, 1, 0, 0, 0]
+        elif node[0] == seqNo:
+            return self.__duplicate(node)
+        else:
+            node[0] = seqNo
+            node[1] = 1
+            node[2] += 1
+            node[5] = 0
+        return True
+
+    def stats(self, nodeId):
+        """
+        Return dict of counters of node nodeId or None if not tracked
+        """
+        node = self.__nodes.get(nodeId)
+        if node == None:
+            return None
+        (received, lost, duplicates) = node[2:5]
+        lossRate = 0.0
+        if received + lost > 0:
+            lossRate = float(lost) / (received + lost)
+        return {"received" : received, "lost" : lost, "duplicates" : duplicates, "lossRate" : lossRate}
+
+    def nodes(self):
+        """
+        Return list of tracked node ids
+        """
+        return self.__nodes.keys()
+
+
+    """ Private methods below """
+
+    def __duplicate(self, node):
+        node[4] += 1
+        self.duplicates += 1
+        return False
@@ -0,0 +1,520 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import csv
+import time
+import Queue
+import logging
+import collections
+import threading
+import requests
+from emoncms import kPacketHello, kPacketContactReport, kPacketContactValue
+from rxqueue import RXQueue, kOverflowBlock, kOverflowDropOldest
+from sequence import SequenceTracker
+from metrics import gMetrics
+from tracing import gTracer
+
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None # MqttSink not available
+
+kCsvHeader = ["time", "node", "rssi", "seqNo", "type", "contact", "value", "flags"]
+
+log = logging.getLogger(__name__)
+
+gMetrics.describe("branly_sink_seconds", "histogram", "Time taken by sinks to handle a packet")
+gMetrics.describe("branly_sink_packet_age_seconds", "histogram", "Time from packet arrival until a sink handles it")
+
+def contactValues(packet):
+    """
+    Return list of ContactValues of packet, empty for packets without values
+    """
+    if packet.type == kPacketContactReport or packet.type == kPacketContactValue:
+        return packet.contactValues
+    return []
+
+
+class Sink:
+    """
+    Base class of packet sinks, handed decoded BranlyPackets by a
+    SinkDispatcher. Anything having these methods, such as an Emoncms
+    instance, may be used as a sink.
+    """
+
+    def handlePacket(self, packet):
+        """
+        Handle packet
+        Returns True if all went well
+        """
+        return True
+
+    def flush(self, force = False):
+        """
+        Called regularly and with force set at shutdown, to write batched data
+        Returns True if all went well
+        """
+        return True
+
+    def close(self):
+        """
+        Release resources of the sink, called after a forced flush
+        """
+        pass
+
+
+class SinkDispatcher:
+    """
+    Fans decoded packets out to several sinks. Each sink has its own worker
+    threads, each with a bounded queue, so a slow or failing sink does not
+    hold up the others. Packets from one node always go to the same worker
+    and are handled in order, packets from different nodes may be handled
+    concurrently. When a sink falls behind the oldest packets queued for it
+    are dropped. Duplicate packets are dropped before being fanned out.
+
+    With several modems the same packet may be heard more than once. Given a
+    mergeWindow packets are held that long, copies arriving meanwhile are
+    merged into the held packet keeping the copy with the best RSSI.
+    """
+
+    """
+    Class members
+    """
+    sequences = False # Per node duplicate and loss tracking (SequenceTracker)
+    flushInterval = 1 # Time between calls to flush() of each sink (seconds)
+    mergeWindow = 0   # Time packets are held waiting for copies from other modems, 0 for none (seconds)
+    merged = 0        # Number of copies merged (int)
+
+    def __init__(self, flushInterval = 1, mergeWindow = 0):
+        self.sequences = SequenceTracker()
+        self.flushInterval = flushInterval
+        self.mergeWindow = mergeWindow
+        self.__sinks = []   # Dicts of name, sink, queues, threads and per worker counters
+        self.__quit = False
+        self.__held = {}    # (node id, type, seqNo) -> packet held for merging
+        self.__heldOrder = collections.deque() # (release time, key) of held packets, oldest first
+        self.__heldLock = threading.Lock()
+        self.__merging = mergeWindow > 0
+        self.__merger = None
+        if self.__merging:
+            self.__merger = threading.Thread(target = self.__mergeWorker, name = "sink-merger")
+            self.__merger.daemon = True
+            self.__merger.start()
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "SinkDispatcher: %s" % ", ".join([s["name"] for s in self.__sinks])
+        return str
+
+    def addSink(self, name, sink, workers = 1, queueSize = 1000, policy = kOverflowDropOldest, keyFunc = None):
+        """
+        Start delivering packets to sink, handled by workers threads. Each
+        worker has a queue of queueSize packets following policy, see RXQueue,
+        with keyFunc(packet) giving the key of the coalesce policy.
+        """
+        entry = {"name" : name, "sink" : sink, "queues" : [], "threads" : [], "handled" : [0] * workers, "failed" : [0] * workers}
+        for i in range(workers):
+            queue = RXQueue(queueSize, policy, keyFunc)
+            thread = threading.Thread(target = self.__worker, args = (entry, i, queue), name = "sink-%s-%d" % (name, i))
+            thread.daemon = True
+            entry["queues"].append(queue)
+            entry["threads"].append(thread)
+        self.__sinks.append(entry)
+        for thread in entry["threads"]:
+            thread.start()
+
+    def put(self, packet):
+        """
+        Queue packet for all sinks, never blocking unless a sink was added with
+        the kOverflowBlock policy.
+        Returns False if the packet was a duplicate and dropped
+        """
+        if self.__merging:
+            key = (packet.fromAddr, packet.type, packet.seqNo)
+            with self.__heldLock:
+                held = self.__held.get(key)
+                if held == None:
+                    self.__held[key] = packet
+                    self.__heldOrder.append((time.time() + self.mergeWindow, key))
+                    return True
+                self.merged += 1
+                if packet.rssi > held.rssi:
+                    if packet.trace == None:
+                        packet.trace = held.trace
+                    self.__held[key] = packet
+            log.debug("Merged packet #%d from node %d heard by %s", packet.seqNo, packet.fromAddr, packet.modem)
+            return False
+        return self.__dispatch(packet)
+
+    def blocked(self):
+        """
+        Return True if put() would block, ie. a queue of a sink added with the
+        kOverflowBlock policy is full
+        """
+        for entry in self.__sinks:
+            for queue in entry["queues"]:
+                if queue.policy == kOverflowBlock and queue.full():
+                    return True
+        return False
+
+    def stats(self):
+        """
+        Return dict of sink name -> dict of counters
+        """
+        stats = {}
+        for entry in self.__sinks:
+            queues = [q.stats() for q in entry["queues"]]
+            stats[entry["name"]] = {"size" : sum([q["size"] for q in queues]), "dropped" : sum([q["dropped"] for q in queues]),
+                                    "handled" : sum(entry["handled"]), "failed" : sum(entry["failed"])}
+        return stats
+
+    def close(self, timeout = 10):
+        """
+        Stop the workers once their queues are empty, at most waiting timeout
+        seconds, then flush and close all sinks
+        """
+        if self.__merger:
+            self.__merging = False
+            self.__merger.join()
+        self.__quit = True
+        deadline = time.time() + timeout
+        for entry in self.__sinks:
+            for thread in entry["threads"]:
+                thread.join(max(0, deadline - time.time()))
+        for entry in self.__sinks:
+            try:
+                entry["sink"].flush(True)
+                entry["sink"].close()
+            except Exception:
+                log.error("Failed to close sink %s" % entry["name"], exc_info = True)
+
+
+    """ Private methods below """
+
+    def __dispatch(self, packet):
+        """
+        Drop duplicate packets and queue the others for all sinks
+        """
+        if packet.type == kPacketHello:
+            new = self.sequences.restart(packet.fromAddr, packet.seqNo)
+        else:
+            new = self.sequences.check(packet.fromAddr, packet.seqNo)
+        if not new:
+            log.info("Skipping duplicate packet #%d from node %d", packet.seqNo, packet.fromAddr)
+            return False
+        if packet.trace != None:
+            gTracer.event(packet.trace, "dispatch")
+        for entry in self.__sinks:
+            queues = entry["queues"]
+            queues[packet.fromAddr % len(queues)].put(packet)
+        return True
+
+    def __mergeWorker(self):
+        """
+        Thread dispatching held packets once their merge window has passed,
+        and all of them when closing
+        """
+        while True:
+            released = []
+            with self.__heldLock:
+                now = time.time()
+                while len(self.__heldOrder) > 0 and (self.__heldOrder[0][0] <= now or not self.__merging):
+                    (releaseTime, key) = self.__heldOrder.popleft()
+                    released.append(self.__held.pop(key))
+                if len(self.__heldOrder) > 0:
+                    wait = self.__heldOrder[0][0] - now
+                else:
+                    wait = self.mergeWindow
+            for packet in released:
+                self.__dispatch(packet)
+            if not self.__merging:
+                return
+            time.sleep(wait)
+
+    def __worker(self, entry, index, queue):
+        """
+        Thread delivering packets from queue to the sink of entry
+        """
+        sink = entry["sink"]
+        labels = {"sink" : entry["name"]}
+        lastFlush = time.time()
+        while not self.__quit or queue.qsize() > 0:
+            try:
+                packet = queue.get(timeout = self.flushInterval)
+                start = time.time()
+                gMetrics.observe("branly_sink_packet_age_seconds", labels, start - packet.timestamp)
+                if packet.trace != None:
+                    gTracer.event(packet.trace, "sink %s" % entry["name"])
+                    gTracer.activate(packet.trace)
+                try:
+                    success = sink.handlePacket(packet)
+                    gMetrics.observe("branly_sink_seconds", labels, time.time() - start)
+                    if packet.trace != None:
+                        gTracer.event(packet.trace, "sink %s done" % entry["name"])
+                    if success:
+                        entry["handled"][index] += 1
+                    else:
+                        entry["failed"][index] += 1
+                        log.error("Sink %s failed to handle packet", entry["name"])
+                except Exception:
+                    entry["failed"][index] += 1
+                    log.critical("Sink %s got exception" % entry["name"], exc_info = True)
+                if packet.trace != None:
+                    gTracer.activate(None)
+            except Queue.Empty:
+                pass
+            if time.time() - lastFlush >= self.flushInterval:
+                lastFlush = time.time()
+                try:
+                    sink.flush()
+                except Exception:
+                    log.critical("Sink %s got exception" % entry["name"], exc_info = True)
+
+
+class MqttSink(Sink):
+    """
+    Publishes packets to an MQTT broker, the RSSI of each packet to
+    <topic>/<node id>/rssi and contact values to <topic>/<node id>/c<contact id>.
+    Requires paho-mqtt. The client connects and reconnects in the background.
+    """
+
+    """
+    Class members
+    """
+    topic = False     # Topic prefix (string)
+    qos = 0           # Quality of service of published messages (int)
+    retain = False    # Ask the broker to retain the last value of each topic (boolean)
+    client = False    # MQTT client (paho.mqtt.client.Client)
+
+    def __init__(self, host, port = 1883, topic = "branly", qos = 0, retain = False, clientId = ""):
+        if mqtt == None:
+            raise ImportError("MqttSink requires paho-mqtt")
+        self.topic = topic
+        self.qos = qos
+        self.retain = retain
+        if hasattr(mqtt, "CallbackAPIVersion"):
+            self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id = clientId)
+        else:
+            self.client = mqtt.Client(client_id = clientId)
+        self.client.connect_async(host, port)
+        self.client.loop_start()
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "MqttSink: topic:%s qos:%d" % (self.topic, self.qos)
+        return str
+
+    def handlePacket(self, packet):
+        success = self.__publish("%s/%d/rssi" % (self.topic, packet.fromAddr), packet.rssi)
+        for value in contactValues(packet):
+            success = self.__publish("%s/%d/c%d" % (self.topic, packet.fromAddr, value.id), value.value) and success
+        return success
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+    """ Private methods below """
+
+    def __publish(self, topic, value):
+        info = self.client.publish(topic, "%s" % value, self.qos, self.retain)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+
+class InfluxSink(Sink):
+    """
+    Writes packets to InfluxDB in batches using the line protocol:
+
+      packet,node=<node id>[,modem=<modem>] rssi=<rssi>i,seqNo=<seqNo>i,type=<type>i <time>
+      contact,node=<node id>,contact=<contact id> value=<value>,flags=<flags>i <time>
+
+    Batches are posted to <url>/write when maxLines are pending or the oldest
+    pending line is maxDelay seconds old. Lines are kept for the next flush if
+    the post fails, at most maxPending of them.
+    """
+
+    """
+    Class members
+    """
+    url = False       # Write endpoint (string)
+    database = False  # Database name (string)
+    maxLines = 500    # Post batch when this many lines are pending (int)
+    maxDelay = 10     # Post batch when the oldest line is this old (seconds)
+    maxPending = 10000 # Max lines kept while InfluxDB is unreachable (int)
+    timeout = False   # (connect, read) timeout of posts (seconds)
+    session = False   # Persistent HTTP session (requests.Session)
+
+    def __init__(self, url, database, maxLines = 500, maxDelay = 10, maxPending = 10000, timeout = (3.05, 10), username = None, password = None):
+        self.url = url.rstrip("/") + "/write"
+        self.database = database
+        self.maxLines = maxLines
+        self.maxDelay = maxDelay
+        self.maxPending = maxPending
+        self.timeout = timeout
+        self.session = requests.Session()
+        if username:
+            self.session.auth = (username, password)
+        self.__lines = []          # Pending lines
+        self.__oldest = None       # Arrival time of the oldest pending line
+        self.__lock = threading.Lock()
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "InfluxSink: %s db:%s" % (self.url, self.database)
+        return str
+
+    def handlePacket(self, packet):
+        timestamp = int(packet.timestamp * 1000)
+        tags = "node=%d" % packet.fromAddr
+        if packet.modem:
+            tags = tags + ",modem=%s" % packet.modem
+        lines = ["packet,%s rssi=%di,seqNo=%di,type=%di %d" % (tags, packet.rssi, packet.seqNo, packet.type, timestamp)]
+        for value in contactValues(packet):
+            lines.append("contact,node=%d,contact=%d value=%s,flags=%di %d" % (packet.fromAddr, value.id, float(value.value), value.flags, timestamp))
+        with self.__lock:
+            if len(self.__lines) == 0:
+                self.__oldest = time.time()
+            self.__lines.extend(lines)
+            full = len(self.__lines) >= self.maxLines
+        if full:
+            return self.flush()
+        return True
+
+    def flush(self, force = False):
+        with self.__lock:
+            lines = self.__lines
+            if len(lines) == 0:
+                return True
+            if not force and len(lines) < self.maxLines and time.time() - self.__oldest < self.maxDelay:
+                return True
+            self.__lines = []
+        if self.__post(lines):
+            return True
+        with self.__lock:
+            lines.extend(self.__lines)
+            if len(lines) > self.maxPending:
+                log.error("InfluxDB buffer full, dropping %d lines" % (len(lines) - self.maxPending))
+                lines = lines[-self.maxPending:]
+            self.__lines = lines
+        return False
+
+    def close(self):
+        self.session.close()
+
+
+    """ Private methods below """
+
+    def __post(self, lines):
+        try:
+            r = self.session.post(self.url, params = {"db" : self.database, "precision" : "ms"}, data = "\n".join(lines), timeout = self.timeout)
+        except requests.exceptions.RequestException as e:
+            log.error("InfluxDB write failed : %s" % e)
+            return False
+        if r.status_code != 204:
+            log.error("InfluxDB write failed : %d %s" % (r.status_code, r.text))
+            return False
+        return True
+
+
+class CsvSink(Sink):
+    """
+    Appends packets to <directory>/packets.csv with one row per contact
+    value, or one row without contact for packets without values:
+
+      time,node,rssi,seqNo,type,contact,value,flags
+
+    When the file reaches maxBytes it is renamed packets.csv.1, older files
+    being renamed .2, .3 and so on, keeping at most backupCount old files.
+    """
+
+    """
+    Class members
+    """
+    path = False      # Current file (string)
+    maxBytes = False  # Rotate file at this size (bytes)
+    backupCount = False # Number of rotated files kept (int)
+
+    def __init__(self, directory, maxBytes = 10485760, backupCount = 10):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, "packets.csv")
+        self.maxBytes = maxBytes
+        self.backupCount = backupCount
+        self.__lock = threading.Lock()
+        self.__open()
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "CsvSink: %s" % (self.path)
+        return str
+
+    def handlePacket(self, packet):
+        row = ["%.3f" % packet.timestamp, packet.fromAddr, packet.rssi, packet.seqNo, packet.type]
+        values = contactValues(packet)
+        with self.__lock:
+            if len(values) == 0:
+                self.__writer.writerow(row + ["", "", ""])
+            for value in values:
+                self.__writer.writerow(row + [value.id, value.value, value.flags])
+            if self.__file.tell() >= self.maxBytes:
+                self.__rotate()
+        return True
+
+    def flush(self, force = False):
+        with self.__lock:
+            self.__file.flush()
+        return True
+
+    def close(self):
+        with self.__lock:
+            self.__file.close()
+
+
+    """ Private methods below, called with self.__lock held """
+
+    def __open(self):
+        self.__file = open(self.path, "ab")
+        self.__writer = csv.writer(self.__file)
+        if self.__file.tell() == 0:
+            self.__writer.writerow(kCsvHeader)
+
+    def __rotate(self):
+        self.__file.close()
+        for i in range(self.backupCount - 1, 0, -1):
+            if os.path.exists("%s.%d" % (self.path, i)):
+                os.rename("%s.%d" % (self.path, i), "%s.%d" % (self.path, i + 1))
+        if self.backupCount > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self.__open()
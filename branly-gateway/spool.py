@@ -0,0 +1,265 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class Spool:
+    """
+    A write-ahead spool of records on disk.
+
+    Records are appended as JSON lines to segment files named
+    spool-<number>.log in the spool directory. A new segment is started when
+    the current one reaches segmentSize bytes. Appended records are fsync'ed at
+    most every syncInterval seconds to spare the SD card. Records are read in
+    order with peek() and removed with ack(). The read position is kept in the
+    file spool.ack and segments that have been fully acked are deleted. If the
+    spool grows beyond maxBytes the oldest segments are deleted, acked or not.
+    """
+
+    """
+    Class members
+    """
+    directory = False    # Spool directory (string)
+    segmentSize = False  # Max size of a segment (bytes)
+    maxBytes = False     # Max size of all segments (bytes)
+    syncInterval = False # Max time between fsyncs (seconds)
+    pending = 0          # Number of records not acked (int)
+    dropped = 0          # Number of records deleted before being acked (int)
+
+    def __init__(self, directory, segmentSize = 1048576, maxBytes = 67108864, syncInterval = 5):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxBytes = maxBytes
+        self.syncInterval = syncInterval
+        self.__lock = threading.Lock()
+        self.__writer = None      # File object of the current segment
+        self.__lastSync = time.time()
+        self.__dirty = False      # True if there are appended records not fsync'ed
+        self.__oldest = None      # Cached first pending record
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__segments = sorted([int(m.group(1)) for m in [re.match(r"spool-(\d+)\.log$", f) for f in os.listdir(directory)] if m])
+        self.__readAck()
+        self.pending = sum([self.__countFrom(self.__ack, s) for s in self.__segments])
+        if len(self.__segments) == 0:
+            self.__segments.append(0)
+        elif not self.__endsWithNewline(self.__segments[-1]):
+            # Do not append to a record cut short by a crash
+            self.__segments.append(self.__segments[-1] + 1)
+        self.__writer = open(self.__segmentPath(self.__segments[-1]), "ab")
+        log.info("%s" % self)
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "Spool at %s: %d segments, %d bytes, %d pending" % (self.directory, len(self.__segments), self.__size(), self.pending)
+        return str
+
+    def append(self, record):
+        """
+        Append JSON serializable record to the spool
+        """
+        line = json.dumps(record, separators=(',', ':')) + "\n"
+        with self.__lock:
+            self.__writer.write(line)
+            self.__dirty = True
+            self.pending += 1
+            if self.__writer.tell() >= self.segmentSize:
+                self.__rotate()
+            elif time.time() - self.__lastSync >= self.syncInterval:
+                self.__sync()
+
+    def sync(self, force = False):
+        """
+        Fsync appended records if syncInterval has passed or if force is True
+        """
+        with self.__lock:
+            if force or time.time() - self.__lastSync >= self.syncInterval:
+                self.__sync()
+
+    def oldest(self):
+        """
+        Return the oldest pending record or None if there is none
+        """
+        with self.__lock:
+            if self.__oldest == None and self.pending > 0:
+                (records, cursor) = self.__read(1)
+                if len(records) > 0:
+                    self.__oldest = records[0]
+            return self.__oldest
+
+    def peek(self, maxRecords):
+        """
+        Return (records, cursor) with up to maxRecords of the oldest pending
+        records. Pass cursor to ack() to remove them from the spool.
+        """
+        with self.__lock:
+            return self.__read(maxRecords)
+
+    def ack(self, cursor):
+        """
+        Remove all records up to cursor, as returned by peek()
+        """
+        with self.__lock:
+            (segment, offset, count) = cursor
+            self.pending -= count
+            self.__ack = (segment, offset)
+            self.__oldest = None
+            # Delete segments that have been read to the end
+            while len(self.__segments) > 1 and self.__ack[0] == self.__segments[0] and self.__ack[1] >= os.path.getsize(self.__segmentPath(self.__segments[0])):
+                os.remove(self.__segmentPath(self.__segments.pop(0)))
+                self.__ack = (self.__segments[0], 0)
+            while len(self.__segments) > 1 and self.__segments[0] < self.__ack[0]:
+                os.remove(self.__segmentPath(self.__segments.pop(0)))
+            self.__writeAck()
+
+    def close(self):
+        """
+        Fsync and close the spool
+        """
+        with self.__lock:
+            self.__sync()
+            self.__writer.close()
+
+
+    """ Private methods below, called with self.__lock held """
+
+    def __segmentPath(self, segment):
+        return os.path.join(self.directory, "spool-%08d.log" % segment)
+
+    def __size(self):
+        return sum([os.path.getsize(self.__segmentPath(s)) for s in self.__segments if os.path.exists(self.__segmentPath(s))])
+
+    def __endsWithNewline(self, segment):
+        with open(self.__segmentPath(segment), "rb") as f:
+            f.seek(0, os.SEEK_END)
+            if f.tell() == 0:
+                return True
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == "\n"
+
+    def __sync(self):
+        if self.__dirty:
+            self.__writer.flush()
+            os.fsync(self.__writer.fileno())
+            self.__dirty = False
+        self.__lastSync = time.time()
+
+    def __rotate(self):
+        """
+        Close the current segment, start a new one and enforce maxBytes
+        """
+        self.__sync()
+        self.__writer.close()
+        self.__segments.append(self.__segments[-1] + 1)
+        self.__writer = open(self.__segmentPath(self.__segments[-1]), "ab")
+        while len(self.__segments) > 1 and self.__size() > self.maxBytes:
+            segment = self.__segments[0]
+            if self.__ack[0] == segment:
+                lost = self.__countFrom(self.__ack, segment)
+                self.pending -= lost
+                self.dropped += lost
+                log.error("Spool full, dropping %d records" % lost)
+            os.remove(self.__segmentPath(self.__segments.pop(0)))
+            if self.__ack[0] == segment:
+                self.__ack = (self.__segments[0], 0)
+                self.__oldest = None
+        self.__writeAck()
+
+    def __readAck(self):
+        """
+        Read position of the first pending record
+        """
+        self.__ack = None
+        try:
+            with open(os.path.join(self.directory, "spool.ack"), "rb") as f:
+                (segment, offset) = [int(v) for v in f.read().split()]
+            if segment in self.__segments:
+                self.__ack = (segment, offset)
+        except (IOError, ValueError):
+            pass
+        if self.__ack == None:
+            if len(self.__segments) > 0:
+                self.__ack = (self.__segments[0], 0)
+            else:
+                self.__ack = (0, 0)
+
+    def __writeAck(self):
+        path = os.path.join(self.directory, "spool.ack")
+        with open(path + ".tmp", "wb") as f:
+            f.write("%d %d\n" % self.__ack)
+        os.rename(path + ".tmp", path)
+
+    def __read(self, maxRecords):
+        """
+        Return (records, cursor) of up to maxRecords starting at the ack position.
+        The cursor is (segment, offset, number of records) after the last record,
+        the number including corrupt records skipped so they leave pending when acked.
+        """
+        self.__writer.flush()
+        records = []
+        skipped = 0
+        (segment, offset) = self.__ack
+        for s in self.__segments:
+            if s < segment:
+                continue
+            if s > segment:
+                (segment, offset) = (s, 0)
+            with open(self.__segmentPath(s), "rb") as f:
+                f.seek(offset)
+                while len(records) < maxRecords:
+                    line = f.readline()
+                    if not line.endswith("\n"):
+                        break # End of segment or record being written
+                    offset += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        log.error("Skipping corrupt spool record '%s'" % line.rstrip())
+                        skipped += 1
+            if len(records) >= maxRecords:
+                break
+        return (records, (segment, offset, len(records) + skipped))
+
+    def __countFrom(self, start, segment):
+        """
+        Return number of complete records in segment, from position start if
+        it is in that segment
+        """
+        if segment < start[0]:
+            return 0
+        count = 0
+        with open(self.__segmentPath(segment), "rb") as f:
+            if segment == start[0]:
+                f.seek(start[1])
+            for line in f:
+                if line.endswith("\n"):
+                    count += 1
+        return count
@@ -0,0 +1,279 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import re
+import mmap
+import time
+import struct
+import logging
+import threading
+from sinks import Sink, contactValues
+
+kRingMagic = "BRS1"
+kRingHeader = struct.Struct("<4sIQ")  # Magic, capacity, number of samples ever appended
+kRingHeaderSize = 32
+kRingColumns = ("d", "d", "B", "b")     # Timestamp, value, flags, rssi
+kRingFile = re.compile(r"n(\d+)-c(\d+)\.ring$")
+kQueryChunk = 1000                      # Samples read by a query per hold of the store lock
+
+log = logging.getLogger(__name__)
+
+class SampleRing:
+    """
+    The most recent samples of one contact in a memory mapped file. Samples
+    are (timestamp, value, flags, rssi) tuples stored column by column, each
+    column being an array of capacity values, after a header holding the
+    number of samples appended so far. Once full, new samples overwrite the
+    oldest. Samples are expected to be appended in time order, as they
+    arrive. Not thread safe, see SampleStore.
+    """
+
+    """
+    Class members
+    """
+    path = False      # Ring file (string)
+    capacity = False  # Max samples kept (int)
+    appended = 0      # Number of samples ever appended (int)
+
+    def __init__(self, path, capacity):
+        self.path = path
+        self.__columns = [struct.Struct("<" + c) for c in kRingColumns]
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                (magic, fileCapacity, appended) = kRingHeader.unpack(f.read(kRingHeader.size))
+            if magic == kRingMagic:
+                capacity = fileCapacity # Keep the samples, whatever the current setting
+            else:
+                log.error("%s is no sample ring, overwriting" % path)
+                appended = 0
+        else:
+            appended = 0
+        self.capacity = capacity
+        self.appended = appended
+        size = kRingHeaderSize + capacity * sum([c.size for c in self.__columns])
+        with open(path, "ab") as f:
+            if f.tell() < size:
+                f.truncate(size)
+        self.__file = open(path, "r+b")
+        self.__map = mmap.mmap(self.__file.fileno(), size)
+        self.__offsets = []
+        offset = kRingHeaderSize
+        for column in self.__columns:
+            self.__offsets.append(offset)
+            offset += capacity * column.size
+        self.__writeHeader()
+
+    def __len__(self):
+        return min(self.appended, self.capacity)
+
+    def oldest(self):
+        """
+        Return position of the oldest sample kept, positions counting all
+        samples ever appended. Index 0 is at this position.
+        """
+        return self.appended - len(self)
+
+    def append(self, sample):
+        """
+        Append (timestamp, value, flags, rssi)
+        """
+        slot = self.appended % self.capacity
+        for (column, offset, value) in zip(self.__columns, self.__offsets, sample):
+            column.pack_into(self.__map, offset + slot * column.size, value)
+        self.appended += 1
+        self.__writeHeader()
+
+    def sample(self, index):
+        """
+        Return sample of index, 0 being the oldest sample kept
+        """
+        slot = (self.appended - len(self) + index) % self.capacity
+        return tuple([column.unpack_from(self.__map, offset + slot * column.size)[0] for (column, offset) in zip(self.__columns, self.__offsets)])
+
+    def timestamp(self, index):
+        """
+        Return timestamp of sample of index
+        """
+        slot = (self.appended - len(self) + index) % self.capacity
+        return self.__columns[0].unpack_from(self.__map, self.__offsets[0] + slot * self.__columns[0].size)[0]
+
+    def find(self, timestamp):
+        """
+        Return index of the first sample at or after timestamp
+        """
+        (low, high) = (0, len(self))
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamp(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def flush(self):
+        self.__map.flush()
+
+    def close(self):
+        self.__map.flush()
+        self.__map.close()
+        self.__file.close()
+
+
+    """ Private methods below """
+
+    def __writeHeader(self):
+        kRingHeader.pack_into(self.__map, 0, kRingMagic, self.capacity, self.appended)
+
+
+class SampleStore(Sink):
+    """
+    Sink keeping the most recent contact values of each node in a
+    SampleRing per contact, the file <directory>/n<node id>-c<contact id>.ring,
+    for local queries. Each ring keeps capacity samples. The files are
+    written through memory maps and synced every syncInterval seconds, the
+    kernel writing them back meanwhile.
+    """
+
+    """
+    Class members
+    """
+    directory = False # Directory of ring files (string)
+    capacity = False  # Samples kept per contact (int)
+    syncInterval = False # Max time between syncs (seconds)
+
+    def __init__(self, directory, capacity = 100000, syncInterval = 60):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.capacity = capacity
+        self.syncInterval = syncInterval
+        self.__lock = threading.Lock()
+        self.__rings = {}          # (node id, contact id) -> SampleRing
+        self.__lastSync = time.time()
+        for name in os.listdir(directory):
+            m = kRingFile.match(name)
+            if m:
+                self.__ring((int(m.group(1)), int(m.group(2))))
+        log.info("%s" % self)
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "SampleStore at %s: %d contacts, %d samples per contact" % (self.directory, len(self.__rings), self.capacity)
+        return str
+
+    def handlePacket(self, packet):
+        values = contactValues(packet)
+        if len(values) == 0:
+            return True
+        with self.__lock:
+            for value in values:
+                self.__ring((packet.fromAddr, value.id)).append((packet.timestamp, float(value.value), value.flags & 0xff, packet.rssi))
+        return True
+
+    def flush(self, force = False):
+        with self.__lock:
+            if force or time.time() - self.__lastSync >= self.syncInterval:
+                for ring in self.__rings.values():
+                    ring.flush()
+                self.__lastSync = time.time()
+        return True
+
+    def close(self):
+        with self.__lock:
+            for ring in self.__rings.values():
+                ring.close()
+            self.__rings = {}
+
+    def series(self):
+        """
+        Return list of dicts describing the stored contacts, with node,
+        contact, count and time of first and last sample
+        """
+        series = []
+        with self.__lock:
+            for ((nodeId, contactId), ring) in sorted(self.__rings.items()):
+                if len(ring) > 0:
+                    series.append({"node" : nodeId, "contact" : contactId, "count" : len(ring), "first" : ring.timestamp(0), "last" : ring.timestamp(len(ring) - 1)})
+        return series
+
+    def query(self, nodeId, contactId, start = 0, end = None, step = None, limit = 10000):
+        """
+        Return samples of contact from start up to end (unix time), at most
+        the limit most recent ones, as [timestamp, value, flags, rssi] lists.
+        Given step (seconds) the samples are downsampled to [start of step,
+        min, max, mean, count] lists, steps being aligned to multiples of
+        step. The samples are read kQueryChunk at a time, letting new values
+        in between, so a long query may miss old samples overwritten
+        meanwhile. Slow on large rings, call it off the IOLoop.
+        """
+        if end == None:
+            end = float("inf")
+        key = (nodeId, contactId)
+        with self.__lock:
+            ring = self.__rings.get(key)
+            if ring == None:
+                return []
+            # Positions of the samples to read, not moving as samples are appended
+            last = ring.oldest() + ring.find(end)
+            first = ring.oldest() + ring.find(start)
+            if not step:
+                first = max(first, last - limit)
+        rows = []
+        position = first
+        while position < last:
+            with self.__lock:
+                ring = self.__rings.get(key)
+                if ring == None:
+                    break # Closed
+                oldest = ring.oldest()
+                position = max(position, oldest)
+                samples = [ring.sample(i - oldest) for i in range(position, min(position + kQueryChunk, last))]
+            position += kQueryChunk
+            if not step:
+                rows.extend([list(sample) for sample in samples])
+                continue
+            for (timestamp, value, flags, rssi) in samples:
+                bucket = timestamp - timestamp % step
+                if len(rows) == 0 or rows[-1][0] != bucket:
+                    rows.append([bucket, value, value, 0.0, 0])
+                row = rows[-1]
+                row[1] = min(row[1], value)
+                row[2] = max(row[2], value)
+                row[3] += value
+                row[4] += 1
+        if step:
+            for row in rows:
+                row[3] = row[3] / row[4]
+        return rows[-limit:]
+
+
+    """ Private methods below, called with self.__lock held """
+
+    def __ring(self, key):
+        ring = self.__rings.get(key)
+        if ring == None:
+            ring = self.__rings[key] = SampleRing(os.path.join(self.directory, "n%d-c%d.ring" % key), self.capacity)
+        return ring
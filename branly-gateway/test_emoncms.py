@@ -0,0 +1,113 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests of the node registry of the emoncms client, run with
+python -m unittest discover
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+from emoncms import Emoncms
+
+def contactFeed(feedId, nodeId, contactId, name):
+    return {"id" : "%d" % feedId, "tag" : "bc:%d:%d:2:r" % (nodeId, contactId), "name" : name, "value" : None}
+
+def contactInput(inputId, nodeId, contactId, feedId):
+    return {"id" : "%d" % inputId, "nodeid" : "%d" % nodeId, "name" : "c%d" % contactId, "processList" : "1:%d" % feedId}
+
+
+class ReadBranlyNodesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cachePath = os.path.join(self.directory, "cache.json")
+        self.feeds = []
+        self.inputs = []
+        self.cms = Emoncms("http://localhost", "key")
+        self.cms._Emoncms__apiGet = self.apiGet
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def apiGet(self, api, parameterDict):
+        if api == "feed/list.json":
+            return self.feeds
+        if api == "input/list.json":
+            return self.inputs
+        return False
+
+    def writeCache(self):
+        cache = {"inputs" : {"16:c1" : [11, 1], "16:c2" : [12, 2]},
+                 "nodes" : {"16" : ["Node", [[1, 2, "t", "r"], [2, 2, "h", "r"]]]}}
+        with open(self.cachePath, "wb") as f:
+            json.dump(cache, f)
+
+    def cachedInputs(self):
+        with open(self.cachePath, "rb") as f:
+            return json.load(f)["inputs"]
+
+    def contactIds(self, nodeId):
+        return sorted([c.id for c in self.cms.findNode(nodeId).contacts])
+
+    def testWarmStartForgetsDeletedFeeds(self):
+        # Feed of contact 2 was deleted while the gateway was down
+        self.writeCache()
+        self.feeds = [contactFeed(1, 16, 1, "t")]
+        self.inputs = [contactInput(11, 16, 1, 1), contactInput(12, 16, 2, 2)]
+        self.cms.enableProvisioningCache(self.cachePath)
+        self.assertEqual(self.contactIds(16), [1, 2])
+        self.cms.readBranlyNodes()
+        self.assertEqual(self.contactIds(16), [1])
+        self.assertEqual(sorted(self.cachedInputs().keys()), ["16:c1"])
+
+    def testWarmStartKeepsFeeds(self):
+        self.writeCache()
+        self.feeds = [contactFeed(1, 16, 1, "t"), contactFeed(2, 16, 2, "h")]
+        self.inputs = [contactInput(11, 16, 1, 1), contactInput(12, 16, 2, 2)]
+        self.cms.enableProvisioningCache(self.cachePath)
+        self.cms.readBranlyNodes()
+        self.assertEqual(self.contactIds(16), [1, 2])
+        self.assertEqual(self.cms.readBranlyNodes(), self.cms.nodes)
+
+    def testDeletedFeed(self):
+        self.feeds = [contactFeed(1, 16, 1, "t"), contactFeed(2, 16, 2, "h")]
+        self.cms.readBranlyNodes()
+        self.assertEqual(self.contactIds(16), [1, 2])
+        self.feeds = self.feeds[:1]
+        self.cms.readBranlyNodes()
+        self.assertEqual(self.contactIds(16), [1])
+
+    def testTagEditedInPlace(self):
+        self.feeds = [contactFeed(1, 16, 1, "t")]
+        self.cms.readBranlyNodes()
+        self.feeds = [{"id" : "1", "tag" : "bc:16:1:2:w", "name" : "t", "value" : None}]
+        self.cms.readBranlyNodes()
+        self.assertEqual(self.contactIds(16), [1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""
+Tests of the modem stream decoder, run with python -m unittest discover
+"""
+
+import unittest
+from modem import ModemDecoder, encodeFrame
+
+def frames(count):
+    """
+    Return bytearray of count contact value frames from node 10
+    """
+    data = bytearray()
+    for seqNo in range(count):
+        data.extend(encodeFrame(10, 1, -42, bytearray([4, seqNo, 3, 11])))
+    return data
+
+
+class ModemDecoderTest(unittest.TestCase):
+
+    def testFrames(self):
+        messages = ModemDecoder().feed(frames(30))
+        self.assertEqual(len(messages), 30)
+        self.assertEqual(messages[0], bytearray([10, 1, 0xd6, 4, 0, 3, 11]))
+
+    def testStrayTextStart(self):
+        for stray in (":", "#"):
+            decoder = ModemDecoder()
+            messages = decoder.feed(bytearray(stray) + frames(30))
+            self.assertEqual(len(messages), 30)
+            self.assertEqual(decoder.garbage, 1)
+            self.assertEqual(len(decoder.buffer), 0)
+
+    def testCutFrame(self):
+        decoder = ModemDecoder()
+        messages = decoder.feed(frames(1)[3:] + frames(30))
+        self.assertEqual(len(messages), 30)
+
+    def testMixedInChunks(self):
+        data = bytearray(":P:10:1:-42:04 03 0a;\r\n# Hello world\r\n") + bytearray(":") + frames(30) + bytearray("# Bye\n")
+        decoder = ModemDecoder()
+        messages = []
+        for i in range(0, len(data), 7):
+            messages.extend(decoder.feed(data[i:i + 7]))
+        self.assertEqual(messages[0], ":P:10:1:-42:04 03 0a;")
+        self.assertEqual(messages[1], "# Hello world")
+        self.assertEqual(len([m for m in messages if isinstance(m, bytearray)]), 30)
+        self.assertEqual(messages[-1], "# Bye")
+
+    def testLineWaitsForEnd(self):
+        decoder = ModemDecoder()
+        self.assertEqual(decoder.feed(bytearray("# Hello")), [])
+        self.assertEqual(decoder.feed(bytearray(" world\n")), ["# Hello world"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import os
+import sys
+import time
+import random
+import logging
+import threading
+import collections
+
+log = logging.getLogger(__name__)
+
+class Tracer:
+    """
+    Keeps sampled traces of messages passing through the gateway in a ring
+    buffer of the size most recent ones. A trace is started for a fraction
+    sampleRate of the messages and collects (event, time) tuples as the
+    message is received, dequeued, decoded, handed to sinks and as API calls
+    are made for it. Callers check enabled before calling, so tracing costs
+    next to nothing when disabled.
+
+    A thread working on a traced message may activate() its trace, events
+    logged with mark() by code not knowing the message, such as the emoncms
+    API calls, are then added to it.
+    """
+
+    """
+    Class members
+    """
+    enabled = False   # Tracing enabled (boolean)
+    sampleRate = 0    # Fraction of messages traced (float)
+
+    def __init__(self, size = 1000, sampleRate = 0):
+        self.__traces = collections.deque(maxlen = size)
+        self.__local = threading.local()
+        self.__random = random.Random()
+        self.configure(sampleRate)
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "Tracer: sampleRate:%s traces:%d" % (self.sampleRate, len(self.__traces))
+        return str
+
+    def configure(self, sampleRate, size = None):
+        """
+        Trace fraction sampleRate of the messages, 0 to disable tracing.
+        Keep the size most recent traces if size is given.
+        """
+        if size != None:
+            self.__traces = collections.deque(self.__traces, maxlen = size)
+        self.sampleRate = sampleRate
+        self.enabled = sampleRate > 0
+
+    def start(self, event, timestamp = None):
+        """
+        Start a trace for a fraction sampleRate of the calls, with its first
+        event at timestamp
+        Returns the trace or None if not sampled
+        """
+        if not self.enabled or self.__random.random() >= self.sampleRate:
+            return None
+        if timestamp == None:
+            timestamp = time.time()
+        trace = [(event, timestamp)]
+        self.__traces.append(trace)
+        return trace
+
+    def event(self, trace, event, timestamp = None):
+        """
+        Add event to trace, at timestamp or now
+        """
+        if timestamp == None:
+            timestamp = time.time()
+        trace.append((event, timestamp))
+
+    def activate(self, trace):
+        """
+        Make trace, or None, the trace of this thread used by mark()
+        """
+        self.__local.trace = trace
+
+    def mark(self, event):
+        """
+        Add event to the active trace of this thread, if any
+        """
+        trace = getattr(self.__local, "trace", None)
+        if trace != None:
+            trace.append((event, time.time()))
+
+    def traces(self):
+        """
+        Return list of the buffered traces, oldest first, as lists of
+        (event, milliseconds since the first event)
+        """
+        traces = []
+        for trace in list(self.__traces):
+            start = trace[0][1]
+            traces.append([(event, round(1000 * (t - start), 3)) for (event, t) in list(trace)])
+        return traces
+
+
+class Profiler:
+    """
+    A sampling profiler. Samples the stacks of all threads every interval
+    seconds for a given time and writes them in the folded format read by
+    flamegraph.pl and speedscope, one line per stack:
+
+      <thread>;<file>:<function>;...;<file>:<function> <samples>
+    """
+
+    """
+    Class members
+    """
+    interval = False  # Time between samples (seconds)
+    running = False   # A profile is being taken (boolean)
+
+    def __init__(self, interval = 0.005):
+        self.interval = interval
+        self.__lock = threading.Lock()
+
+    def start(self, seconds, path):
+        """
+        Profile for seconds in the background and write the result to path
+        Returns False if a profile is already being taken
+        """
+        with self.__lock:
+            if self.running:
+                return False
+            self.running = True
+        thread = threading.Thread(target = self.__run, args = (seconds, path), name = "profiler")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def afterFork(self):
+        """
+        Replace the lock in a child process forked while other threads ran.
+        A profile being taken by the parent is not running here.
+        """
+        self.__lock = threading.Lock()
+        self.running = False
+
+
+    """ Private methods below """
+
+    def __run(self, seconds, path):
+        stacks = collections.Counter()
+        names = {}
+        me = threading.current_thread().ident
+        samples = 0
+        try:
+            log.info("Profiling for %d seconds" % seconds)
+            end = time.time() + seconds
+            while time.time() < end:
+                for thread in threading.enumerate():
+                    names[thread.ident] = thread.name
+                for (ident, frame) in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame != None:
+                        code = frame.f_code
+                        stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                        frame = frame.f_back
+                    stack.append(names.get(ident, "thread-%d" % ident))
+                    stacks[";".join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            with open(path, "wb") as f:
+                for (stack, count) in stacks.most_common():
+                    f.write("%s %d\n" % (stack, count))
+            log.info("Wrote profile of %d samples to %s" % (samples, path))
+        except Exception:
+            log.error("Profiling failed", exc_info = True)
+        finally:
+            self.running = False
+
+
+gTracer = Tracer() # Message traces of the gateway
+gProfiler = Profiler()
@@ -0,0 +1,109 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+class ValueFilter:
+    """
+    Decides which contact values are worth posting to the cms.
+
+    A value is posted if it differs from the last posted value of the same
+    key by more than deadband and by more than relative times the last
+    posted value, but not sooner than minInterval seconds after the last post.
+    A value is always posted if heartbeat seconds have passed since the last
+    post, so unchanging contacts are still refreshed. With all settings 0 only
+    values equal to the last posted one are filtered.
+
+    The defaults may be overridden per key, eg. (node id, contact id), with
+    configure() or the overrides dict of key -> dict of settings.
+    """
+
+    """
+    Class members
+    """
+    deadband = 0      # Absolute change needed to post a value (float)
+    relative = 0      # Change relative to the last posted value needed to post a value (float)
+    minInterval = 0   # Min time between posts (seconds)
+    heartbeat = 0     # Post unchanged values this often, 0 for never (seconds)
+    passed = 0        # Number of values to post (int)
+    filtered = 0      # Number of values filtered (int)
+
+    def __init__(self, deadband = 0, relative = 0, minInterval = 0, heartbeat = 0, overrides = None):
+        self.deadband = deadband
+        self.relative = relative
+        self.minInterval = minInterval
+        self.heartbeat = heartbeat
+        self.__settings = {}  # key -> (deadband, relative, minInterval, heartbeat)
+        self.__default = (deadband, relative, minInterval, heartbeat)
+        self.__last = {}      # key -> (last posted value, time of post)
+        if overrides:
+            for (key, settings) in overrides.items():
+                self.configure(key, **settings)
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "ValueFilter: deadband:%s relative:%s minInterval:%s heartbeat:%s passed:%d filtered:%d" % (self.deadband, self.relative, self.minInterval, self.heartbeat, self.passed, self.filtered)
+        return str
+
+    def configure(self, key, deadband = None, relative = None, minInterval = None, heartbeat = None):
+        """
+        Override default settings for key
+        """
+        settings = []
+        for (value, default) in zip((deadband, relative, minInterval, heartbeat), self.__default):
+            if value == None:
+                value = default
+            settings.append(value)
+        self.__settings[key] = tuple(settings)
+
+    def check(self, key, value, timestamp = None):
+        """
+        Returns True if value of key should be posted, it is then recorded as
+        the last posted value
+        """
+        if timestamp == None:
+            timestamp = time.time()
+        last = self.__last.get(key)
+        if last != None:
+            (deadband, relative, minInterval, heartbeat) = self.__settings.get(key, self.__default)
+            elapsed = timestamp - last[1]
+            if not heartbeat or elapsed < heartbeat:
+                change = abs(value - last[0])
+                if elapsed < minInterval or change <= deadband or change <= relative * abs(last[0]):
+                    self.filtered += 1
+                    return False
+        self.__last[key] = (value, timestamp)
+        self.passed += 1
+        return True
+
+    def forget(self, key):
+        """
+        Forget the last posted value of key, eg. when posting it failed, so the
+        next value is posted
+        """
+        self.__last.pop(key, None)
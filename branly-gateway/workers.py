@@ -0,0 +1,156 @@
+#
+# Copyright (c) 2015 Johan Kanflo (github.com/kanflo)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+import time
+import Queue
+import logging
+import multiprocessing
+
+log = logging.getLogger(__name__)
+
+class WorkerPool:
+    """
+    A pool of worker processes, each with a bounded queue of its own. Items
+    are sharded by key so items with the same key always go to the same
+    worker and are handled in order. The worker processes run target(index,
+    queue), which returns when it gets None from its queue. supervise() is
+    to be called regularly to restart workers that died. A restarted worker
+    gets a new queue, as the old one may have been left locked by the dead
+    worker, so items waiting for it are lost. Items are also dropped when a
+    worker's queue is full.
+    """
+
+    """
+    Class members
+    """
+    processes = False # Number of workers (int)
+    target = False    # Function run by the workers (callable)
+    queueSize = False # Max items waiting for each worker (int)
+
+    def __init__(self, processes, target, queueSize = 1000):
+        self.processes = processes
+        self.target = target
+        self.queueSize = queueSize
+        self.__queues = []
+        self.__workers = []
+        self.__dropped = [0] * processes
+        self.__restarts = [0] * processes
+        self.__running = False
+
+    def __str__(self):
+        """
+        Return string describing this object
+        """
+        str = "WorkerPool: %d processes, %d alive, %d restarts, %d dropped" % (self.processes, len([w for w in self.__workers if w.is_alive()]), sum(self.__restarts), sum(self.__dropped))
+        return str
+
+    def start(self):
+        """
+        Start the workers
+        """
+        for index in range(self.processes):
+            self.__queues.append(multiprocessing.Queue(self.queueSize))
+            self.__workers.append(self.__start(index))
+        self.__running = True
+
+    def put(self, key, item):
+        """
+        Queue item for the worker of key (int), never blocking
+        Returns False if the worker's queue was full and the item was dropped
+        """
+        index = key % self.processes
+        try:
+            self.__queues[index].put_nowait(item)
+        except Queue.Full:
+            self.__dropped[index] += 1
+            return False
+        return True
+
+    def supervise(self):
+        """
+        Restart workers that died
+        Returns number of workers restarted
+        """
+        restarted = 0
+        if not self.__running:
+            return restarted
+        for (index, worker) in enumerate(self.__workers):
+            if not worker.is_alive():
+                log.error("Worker %d died with exit code %s, restarting" % (index, worker.exitcode))
+                worker.join()
+                self.__queues[index].cancel_join_thread() # Do not wait for items nobody will read
+                self.__queues[index].close()
+                self.__queues[index] = multiprocessing.Queue(self.queueSize)
+                self.__workers[index] = self.__start(index)
+                self.__restarts[index] += 1
+                restarted += 1
+        return restarted
+
+    def pids(self):
+        """
+        Return list of process ids of the workers
+        """
+        return [worker.pid for worker in self.__workers]
+
+    def stats(self):
+        """
+        Return list of dicts of counters, one per worker
+        """
+        stats = []
+        for index in range(self.processes):
+            try:
+                size = self.__queues[index].qsize()
+            except NotImplementedError:
+                size = 0 # Not available on a Mac
+            stats.append({"size" : size, "dropped" : self.__dropped[index], "restarts" : self.__restarts[index]})
+        return stats
+
+    def stop(self, timeout = 10):
+        """
+        Ask the workers to stop once they have handled their queues, at most
+        waiting timeout seconds before terminating them. Workers whose queue
+        is full cannot be asked and are terminated after timeout.
+        """
+        self.__running = False
+        deadline = time.time() + timeout
+        for (index, queue) in enumerate(self.__queues):
+            try:
+                queue.put_nowait(None)
+            except Queue.Full:
+                # Dead or stuck, a blocking put would never return
+                log.error("Queue of worker %d is full, it will be terminated if it does not stop in time" % index)
+        for (index, worker) in enumerate(self.__workers):
+            worker.join(max(0, deadline - time.time()))
+            if worker.is_alive():
+                log.error("Worker %d did not stop, terminating" % index)
+                worker.terminate()
+                worker.join()
+
+
+    """ Private methods below """
+
+    def __start(self, index):
+        worker = multiprocessing.Process(target = self.target, args = (index, self.__queues[index]), name = "worker-%d" % index)
+        worker.daemon = True
+        worker.start()
+        return worker
@@ -26,6 +26,7 @@
 #include <RFM69.h>
 #include <SPI.h>
 #include <EEPROM.h>
+#include <util/crc16.h>
 
 #define GATEWAY_SW_VERSION 1
 
@@ -41,8 +42,13 @@
 #define LED           9  // Pin 9 has an LED connected on Branly Pi.
 #define SERIAL_BAUD   115200
 
+#define FRAME_SYNC    0xa5 // First byte of binary packet frames
+#define CMD_BINARY    'B'  // Gateway asks for binary packet frames
+#define CMD_TEXT      'T'  // Gateway asks for text packets
+
 RFM69 radio;
 bool promiscuousMode = false; //set to 'true' to sniff all packets on the same network
+bool binaryMode = false; // Send packets as binary frames, see dump_frame
 
 
 #ifndef ABS
@@ -104,11 +110,54 @@ void dump_report(int src_node, int dst_node, int rssi, char* payload, int payloa
   bprintf(";\n");
 }
 
+// Dump packet as binary frame
+// <0xa5> <length> <from> <to> <rssi> <data 0> ... <data n> <crc lo> <crc hi>
+// where <length> counts <from> to <data n> and the CRC-CCITT covers <length> to <data n>
+void dump_frame(int src_node, int dst_node, int rssi, char* payload, int payload_size)
+{
+  unsigned char header[4] = {(unsigned char) (3 + payload_size), (unsigned char) src_node, (unsigned char) dst_node, (unsigned char) rssi};
+  uint16_t crc = 0xffff;
+  int i;
+  for(i=0; i<4; i++) {
+    crc = _crc_ccitt_update(crc, header[i]);
+  }
+  for(i=0; i<payload_size; i++) {
+    crc = _crc_ccitt_update(crc, ((unsigned char*)payload)[i]);
+  }
+  Serial.write(FRAME_SYNC);
+  Serial.write(header, sizeof(header));
+  Serial.write((unsigned char*)payload, payload_size);
+  Serial.write(crc & 0xff);
+  Serial.write(crc >> 8);
+}
+
+// Handle packet format requests from the gateway
+void handle_command()
+{
+  while (Serial.available()) {
+    switch (Serial.read()) {
+      case CMD_BINARY:
+        binaryMode = true;
+        bprintf("# FRAMING:binary\n");
+        break;
+      case CMD_TEXT:
+        binaryMode = false;
+        bprintf("# FRAMING:text\n");
+        break;
+    }
+  }
+}
+
 
 void loop()
 {
+  handle_command();
   if (radio.receiveDone()) {
-    dump_report(radio.SENDERID, radio.TARGETID, radio.RSSI, (char*) radio.DATA, radio.DATALEN);
+    if (binaryMode) {
+      dump_frame(radio.SENDERID, radio.TARGETID, radio.RSSI, (char*) radio.DATA, radio.DATALEN);
+    } else {
+      dump_report(radio.SENDERID, radio.TARGETID, radio.RSSI, (char*) radio.DATA, radio.DATALEN);
+    }
     if (radio.ACK_REQUESTED) {
       radio.sendACK();
     }